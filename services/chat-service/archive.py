@@ -0,0 +1,252 @@
+"""
+Cold archive of old message partitions.
+
+persistence-service keeps messages partitioned by month (messages_YYYY_MM).
+Once a month falls out of MESSAGE_RETENTION_MONTHS, one chat-service node
+exports its partition to ARCHIVE_DIR as
+
+    messages_YYYY_MM/<conversation_id>.ndjson.gz
+
+(one gzip NDJSON file per conversation, oldest first). The partition is
+detached before it is exported, so no row can be inserted into it after the
+export, and dropped once the export is on disk: retention is a metadata
+operation instead of a bulk DELETE. ARCHIVE_DIR must be shared by every
+chat-service node.
+
+History and sync read archived months through iter_archived_messages, one
+conversation-month at a time.
+"""
+import asyncio
+import gzip
+import json
+import os
+import re
+import shutil
+import time
+from datetime import date, datetime, timezone
+from typing import AsyncIterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from config import ARCHIVE_DIR, ARCHIVE_LIST_TTL, MESSAGE_RETENTION_MONTHS, ARCHIVE_CHECK_INTERVAL
+
+PARTITIONED_TABLE = "messages"
+_PARTITION_NAME = re.compile(rf"^{PARTITIONED_TABLE}_(\d{{4}})_(\d{{2}})$")
+# Only one node archives at a time
+_ARCHIVE_LOCK_ID = 0x6D736761
+
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_of(name: str) -> Optional[date]:
+    match = _PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def month_start(month: date) -> datetime:
+    return datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+# --- Reading ---
+def _list_archived_months() -> List[date]:
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(m for m in map(month_of, names) if m is not None)
+
+
+# (monotonic time listed, months) of the last ARCHIVE_DIR listing
+_archived_months_cache: Tuple[float, List[date]] = (float("-inf"), [])
+
+
+async def archived_months() -> List[date]:
+    """
+    Months that have been archived, oldest first. ARCHIVE_DIR is listed off
+    the event loop at most once per ARCHIVE_LIST_TTL.
+    """
+    global _archived_months_cache
+    listed_at, months = _archived_months_cache
+    if time.monotonic() - listed_at < ARCHIVE_LIST_TTL:
+        return months
+    months = await asyncio.to_thread(_list_archived_months)
+    _archived_months_cache = (time.monotonic(), months)
+    return months
+
+
+def _read_conversation_month(month: date, conversation_id: str) -> list:
+    path = os.path.join(ARCHIVE_DIR, f"{PARTITIONED_TABLE}_{month.year:04d}_{month.month:02d}", f"{conversation_id}.ndjson.gz")
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+async def iter_archived_messages(
+    conversation_id: str,
+    after: Optional[datetime] = None,
+    before: Optional[Tuple[datetime, str]] = None,
+    descending: bool = False,
+) -> AsyncIterator[dict]:
+    """
+    Archived messages of one conversation with sent_at > after and
+    (sent_at, id) < before, in (sent_at, id) order (newest first if
+    descending). Entries have the fields of a messages row, with sent_at as an
+    ISO timestamp. Only one conversation-month is held in memory.
+    """
+    months = [
+        m for m in await archived_months()
+        if (after is None or month_start(add_months(m, 1)) > after)
+        and (before is None or month_start(m) <= before[0])
+    ]
+    if descending:
+        months.reverse()
+    for month in months:
+        messages = await asyncio.to_thread(_read_conversation_month, month, str(conversation_id))
+        if descending:
+            messages.reverse()
+        for m in messages:
+            sent_at = datetime.fromisoformat(m["sent_at"])
+            if after is not None and sent_at <= after:
+                continue
+            if before is not None and (sent_at, m["id"]) >= before:
+                continue
+            yield m
+
+
+# --- Archiving ---
+def _write_conversation_month(directory: str, conversation_id: str, lines: List[str]):
+    with gzip.open(os.path.join(directory, f"{conversation_id}.ndjson.gz"), "wt", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def _merge_conversation_month(directory: str, existing_dir: str, conversation_id: str, lines: List[str]):
+    """
+    Writes `lines` plus whatever an earlier export of the month already holds
+    for the conversation, deduplicated by id and in (sent_at, id) order.
+    """
+    try:
+        with gzip.open(os.path.join(existing_dir, f"{conversation_id}.ndjson.gz"), "rt", encoding="utf-8") as f:
+            lines = list(f) + lines
+    except FileNotFoundError:
+        pass
+    by_id = {}
+    for line in lines:
+        m = json.loads(line)
+        by_id[m["id"]] = (m["sent_at"], m["id"], line)
+    ordered = sorted(by_id.values(), key=lambda entry: (datetime.fromisoformat(entry[0]), entry[1]))
+    _write_conversation_month(directory, conversation_id, [line for _, _, line in ordered])
+
+
+def _prepare_staging(final_dir: str, tmp_dir: str):
+    """
+    Fresh staging directory, holding a copy of the month if it was already
+    exported.
+    """
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if os.path.isdir(final_dir):
+        shutil.copytree(final_dir, tmp_dir)
+    else:
+        os.makedirs(tmp_dir)
+
+
+def _publish_staging(final_dir: str, tmp_dir: str):
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+
+async def export_partition(conn, name: str):
+    """
+    Writes every row of one (detached) partition to ARCHIVE_DIR/<name>/,
+    grouped by conversation. The directory only appears under its final name
+    once complete. If the month was already exported (an export that was
+    interrupted before the DROP), the new rows are merged into it.
+    """
+    final_dir = os.path.join(ARCHIVE_DIR, name)
+    tmp_dir = final_dir + ".tmp"
+    # Directory copies and removals can take a while: off the event loop
+    await asyncio.to_thread(_prepare_staging, final_dir, tmp_dir)
+
+    result = await conn.stream(text(
+        f"SELECT id, conversation_id, user_id, content, type, sent_at FROM {name} "
+        f"ORDER BY conversation_id, sent_at, id"
+    ))
+    current, lines, rows = None, [], 0
+    async for row in result:
+        conversation_id = str(row.conversation_id)
+        if conversation_id != current and lines:
+            await asyncio.to_thread(_merge_conversation_month, tmp_dir, final_dir, current, lines)
+            lines = []
+        current = conversation_id
+        lines.append(json.dumps({
+            "id": str(row.id),
+            "conversation_id": conversation_id,
+            "user_id": str(row.user_id),
+            "content": row.content,
+            "type": row.type,
+            "sent_at": row.sent_at.isoformat(),
+        }) + "\n")
+        rows += 1
+    if lines:
+        await asyncio.to_thread(_merge_conversation_month, tmp_dir, final_dir, current, lines)
+
+    await asyncio.to_thread(_publish_staging, final_dir, tmp_dir)
+    return rows
+
+
+async def archive_old_partitions(engine) -> List[str]:
+    """
+    Detaches, exports and drops every monthly partition older than
+    MESSAGE_RETENTION_MONTHS. Tables left detached by an interrupted run are
+    picked up again. Returns the archived partition names.
+    """
+    global _archived_months_cache
+    if MESSAGE_RETENTION_MONTHS <= 0:
+        return []
+    cutoff = add_months(datetime.now(timezone.utc).date().replace(day=1), -MESSAGE_RETENTION_MONTHS)
+    archived = []
+    async with engine.connect() as conn:
+        if not await conn.scalar(text("SELECT pg_try_advisory_lock(:id)"), {"id": _ARCHIVE_LOCK_ID}):
+            return archived
+        try:
+            # Monthly tables, attached or not (relispartition false: detached by
+            # an interrupted run)
+            tables = (await conn.execute(text(
+                "SELECT c.relname, c.relispartition FROM pg_class c "
+                "WHERE c.relkind = 'r' AND c.relname LIKE :pattern"
+            ), {"pattern": f"{PARTITIONED_TABLE}\\_%"})).all()
+            await conn.commit()
+            for name, attached in sorted(tables):
+                month = month_of(name)
+                if month is None or month >= cutoff:
+                    continue
+                if attached:
+                    # Not CONCURRENTLY: that isn't allowed while messages has a
+                    # default partition. Inserts for this month now go to
+                    # messages_default, which partition maintenance drains.
+                    await conn.execute(text(f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}"))
+                    await conn.commit()
+                rows = await export_partition(conn, name)
+                await conn.execute(text(f"DROP TABLE {name}"))
+                await conn.commit()
+                archived.append(name)
+                _archived_months_cache = (float("-inf"), [])
+                print(f"[archive] Archived {rows} messages from {name} to {ARCHIVE_DIR}")
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": _ARCHIVE_LOCK_ID})
+            await conn.commit()
+    return archived
+
+
+async def archive_loop(engine, interval=ARCHIVE_CHECK_INTERVAL):
+    while True:
+        try:
+            await archive_old_partitions(engine)
+        except Exception as e:
+            print(f"[archive] Archiving failed: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,88 @@
+"""
+Serialization cost per delivered message: legacy JSON node messages vs. the
+pre-encoded payload envelope (message_transport/envelope.py).
+
+Legacy path:   json.loads (ingest) -> json.dumps(node_msg) per node
+               -> json.loads(node_msg) + json.dumps(payload) per device
+Envelope path: json.loads (ingest) -> encode payload once -> pack per node
+               -> unpack + decode once per node
+
+Only CPU work is measured (no broker, no sockets). Run from services/chat-service:
+
+    python -m benchmarks.envelope --content-size 200 --nodes 2 --devices 1,10,100
+"""
+import argparse
+import json
+import time
+import uuid
+
+from message_transport.envelope import encode_payload, pack, unpack
+
+
+def make_frame(content_size):
+    return json.dumps({
+        "conversation_id": str(uuid.uuid4()),
+        "content": "x" * content_size,
+        "type": "text",
+    })
+
+
+def legacy(frame, node_map, sink):
+    message_dict = json.loads(frame)
+    message_dict["sender_id"] = "sender"
+    message_dict["id"] = "id"
+    bodies = [
+        json.dumps({"event_type": "chat_message", "payload": message_dict, "target_devices": devices}).encode("utf-8")
+        for devices in node_map.values()
+    ]
+    for body in bodies:
+        node_msg = json.loads(body.decode("utf-8"))
+        for _ in node_msg["target_devices"]:
+            sink(json.dumps(node_msg["payload"]))
+
+
+def enveloped(frame, node_map, sink):
+    message_dict = json.loads(frame)
+    message_dict["sender_id"] = "sender"
+    message_dict["id"] = "id"
+    payload = encode_payload(message_dict)
+    bodies = [pack("chat_message", message_dict["conversation_id"], devices, payload) for devices in node_map.values()]
+    for body in bodies:
+        _, _, targets, node_payload = unpack(body)
+        text = node_payload.decode("utf-8")
+        for _ in targets:
+            sink(text)
+
+
+def per_delivery_us(fn, frame, node_map, deliveries, repeat):
+    sink = [].append
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(frame, node_map, sink)
+    return (time.perf_counter() - started) / (repeat * deliveries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--content-size", type=int, default=200)
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--devices", default="1,10,100,500", help="devices per node")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    frame = make_frame(args.content_size)
+    print(f"{'devices/node':>12} {'legacy us/delivery':>19} {'envelope us/delivery':>21} {'saved':>7}")
+    for per_node in (int(d) for d in args.devices.split(",")):
+        node_map = {
+            f"node-{n}": [{"user_id": str(uuid.uuid4()), "device_id": f"dev-{d}"} for d in range(per_node)]
+            for n in range(args.nodes)
+        }
+        deliveries = args.nodes * per_node
+        repeat = max(10, args.repeat // per_node)
+        before = per_delivery_us(legacy, frame, node_map, deliveries, repeat)
+        after = per_delivery_us(enveloped, frame, node_map, deliveries, repeat)
+        print(f"{per_node:>12} {before:>19.2f} {after:>21.2f} {1 - after / before:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# Returned by LRUTTLCache.get on a miss, so that falsy values ({} / []) can be cached too
+MISSING = object()
+
+
+class LRUTTLCache:
+    """
+    Bounded in-process cache: least recently used entries are evicted once
+    `max_entries` is reached, and every entry expires `ttl` seconds after it was
+    stored even if nobody invalidates it.
+
+    `generation` is bumped on every invalidation. A caller that loads a value
+    remotely should read it before the load and pass it to `set`, so a result
+    that raced with an invalidation of the same key is not cached;
+    invalidations of other keys meanwhile don't matter. The generation of the
+    last invalidation is remembered for up to `max_entries` keys; a load older
+    than the ones forgotten is not cached either.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        # key -> generation of its last invalidation, oldest first
+        self._invalidated: "OrderedDict[Hashable, int]" = OrderedDict()
+        # Loads started before this generation can't be checked any more
+        self._oldest_checkable = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        if generation is not None and (
+            generation < self._oldest_checkable or self._invalidated.get(key, 0) > generation
+        ):
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self.generation += 1
+        self.invalidations += 1
+        self._entries.pop(key, None)
+        self._invalidated[key] = self.generation
+        self._invalidated.move_to_end(key)
+        while len(self._invalidated) > self.max_entries:
+            _, forgotten = self._invalidated.popitem(last=False)
+            self._oldest_checkable = forgotten
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self._invalidated.clear()
+        self._oldest_checkable = self.generation
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -9,11 +9,38 @@ RABBIT_PORT = int(os.getenv("RABBIT_PORT", "5672"))
 EXCHANGE_NAME = os.getenv("EXCHANGE_NAME", "chat-direct-exchange")
 NODE_ID = os.getenv("NODE_ID", "node-1")  # Each instance should have a unique NODE_ID
 QUEUE_NAME = f"{NODE_ID}-queue"  # Per-node queue
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "200"))  # unacked node messages in flight
+PUBLISHER_CHANNEL_POOL_SIZE = int(os.getenv("PUBLISHER_CHANNEL_POOL_SIZE", "4"))  # confirm-enabled channels
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", "5"))  # seconds to wait for broker confirms
+
+# WebSocket outbound queue per connected device, and what to do when it overflows:
+# "disconnect" closes the slow socket, "drop" discards the frame.
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "disconnect")
+
+# Per-connection ingest pipeline: frames read but not yet persisted/distributed.
+# When full, the socket is not read until the backlog drains.
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "64"))
+INGEST_DRAIN_TIMEOUT = float(os.getenv("INGEST_DRAIN_TIMEOUT", "10"))  # seconds, on disconnect
+# A client sent_at further than this from the server clock is replaced by the
+# server time, so messages always land in a premade monthly partition
+SENT_AT_MAX_AGE = float(os.getenv("SENT_AT_MAX_AGE", str(24 * 3600)))  # seconds in the past
+SENT_AT_MAX_SKEW = float(os.getenv("SENT_AT_MAX_SKEW", "60"))  # seconds in the future
 
 # Redis Config
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 
+# Hot message sets (chat:{cid}:messages, written by persistence-service).
+# A cold set is refilled from Postgres with the window recorded in chat:{cid}:meta,
+# or REDIS_MESSAGE_WINDOW if there is none; one node refills at a time.
+REDIS_MESSAGE_WINDOW = int(os.getenv("REDIS_MESSAGE_WINDOW", "100"))
+REDIS_META_TTL = int(os.getenv("REDIS_META_TTL", str(7 * 24 * 3600)))
+HOT_REFILL_LOCK_MS = int(os.getenv("HOT_REFILL_LOCK_MS", "5000"))
+# Background refills a sync may start for cold sets while others are running;
+# past that, cold conversations are served from Postgres without a refill
+HOT_REFILL_MAX_PENDING = int(os.getenv("HOT_REFILL_MAX_PENDING", "32"))
+
 # Authentication Config
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_SECRET_KEY = os.getenv("ACCESS_SECRET_KEY", "access_secret_key")
@@ -26,6 +53,50 @@ DATABASE_URL = os.getenv(
 # Presence Service URL
 PRESENCE_SERVICE_URL = os.getenv("PRESENCE_SERVICE_URL", "http://presence-service:8004")
 
+# Node lease in presence-service: while it is alive this node's devices are
+# routable; if the process dies the lease expires and they stop being routed here
+NODE_LEASE_TTL = float(os.getenv("NODE_LEASE_TTL", "15"))  # seconds
+NODE_LEASE_RENEW_INTERVAL = float(os.getenv("NODE_LEASE_RENEW_INTERVAL", "5"))  # seconds
+
+# Device connect/disconnect events are sent to presence-service in batches:
+# collected for up to PRESENCE_BATCH_WINDOW, at most PRESENCE_BATCH_MAX_SIZE devices per call
+PRESENCE_BATCH_WINDOW = float(os.getenv("PRESENCE_BATCH_WINDOW", "0.05"))  # seconds
+PRESENCE_BATCH_MAX_SIZE = int(os.getenv("PRESENCE_BATCH_MAX_SIZE", "500"))
+
+# Local presence routing cache (invalidated through the presence_updates channel)
+PRESENCE_UPDATES_CHANNEL = os.getenv("PRESENCE_UPDATES_CHANNEL", "presence_updates")
+PRESENCE_CACHE_TTL = float(os.getenv("PRESENCE_CACHE_TTL", "30"))  # seconds
+PRESENCE_CACHE_MAX_ENTRIES = int(os.getenv("PRESENCE_CACHE_MAX_ENTRIES", "100000"))
+
+# Presence pushed to WebSocket clients that subscribe to contacts: a change is
+# pushed PRESENCE_PUSH_DEBOUNCE after its event, at most once per
+# PRESENCE_PUSH_MIN_INTERVAL per contact
+PRESENCE_PUSH_DEBOUNCE = float(os.getenv("PRESENCE_PUSH_DEBOUNCE", "0.5"))  # seconds
+PRESENCE_PUSH_MIN_INTERVAL = float(os.getenv("PRESENCE_PUSH_MIN_INTERVAL", "5"))  # seconds
+PRESENCE_MAX_SUBSCRIPTIONS = int(os.getenv("PRESENCE_MAX_SUBSCRIPTIONS", "1000"))  # per connection
+
+# Local group membership cache (invalidated through the conversation_updates channel)
+CONVERSATION_UPDATES_CHANNEL = os.getenv("CONVERSATION_UPDATES_CHANNEL", "conversation_updates")
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))  # seconds
+MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.getenv("MEMBERSHIP_CACHE_MAX_ENTRIES", "50000"))
+
+# Cold archive: monthly message partitions older than MESSAGE_RETENTION_MONTHS
+# are exported to ARCHIVE_DIR (shared by all nodes) and dropped. 0 disables.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/data/archive")
+MESSAGE_RETENTION_MONTHS = int(os.getenv("MESSAGE_RETENTION_MONTHS", "12"))
+ARCHIVE_CHECK_INTERVAL = int(os.getenv("ARCHIVE_CHECK_INTERVAL", "3600"))  # seconds
+# How long a listing of archived months is reused by history and sync reads
+ARCHIVE_LIST_TTL = float(os.getenv("ARCHIVE_LIST_TTL", "60"))  # seconds
+
+# Characters of message content kept in conversation:{cid}:preview (same as persistence-service)
+PREVIEW_LENGTH = int(os.getenv("PREVIEW_LENGTH", "200"))
+# A chat list rebuilt from Postgres is trusted for this long, then rebuilt on
+# the next first-page read (rebuilds only add or raise entries)
+CHAT_LIST_BUILT_TTL = int(os.getenv("CHAT_LIST_BUILT_TTL", str(24 * 3600)))  # seconds
+
+# Streaming /sync: conversations synced (and emitted) per round of queries
+SYNC_STREAM_CHUNK_SIZE = int(os.getenv("SYNC_STREAM_CHUNK_SIZE", "20"))
+
 
 # Exchange name
 EXCHANGE_NAME = os.getenv("EXCHANGE_NAME", "chat-direct-exchange")
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import Optional
+
+from fastapi import WebSocket
+from fastapi.websockets import WebSocketState
+
+from config import OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_POLICY
+
+# Close code sent to clients that are disconnected for not keeping up (RFC 6455 "Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class ClientConnection:
+    """
+    One connected device: its WebSocket plus a bounded outbound queue drained by
+    a dedicated writer task. `send` never waits on the socket, so a slow client
+    only ever delays itself.
+
+    When the queue is full the SLOW_CONSUMER_POLICY applies:
+      - "disconnect": close the socket; the client reconnects and catches up via /sync
+      - "drop": discard the new frame and keep the connection
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, device_id: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.device_id = device_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.dropped = 0
+        self.closed = False
+        self._writer_task: Optional[asyncio.Task] = None
+        # Slow-consumer close started from send(), kept so it isn't garbage-collected
+        self._close_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def send(self, text: str) -> bool:
+        """
+        Queues a text frame for this device. Returns False if it was not queued.
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if SLOW_CONSUMER_POLICY == "drop":
+                logging.warning("[chat-service] Outbound queue full for %s:%s, dropping frame",
+                                self.user_id, self.device_id)
+            else:
+                logging.warning("[chat-service] Outbound queue full for %s:%s, disconnecting slow consumer",
+                                self.user_id, self.device_id)
+                if self._close_task is None:
+                    self._close_task = asyncio.create_task(self.close(code=SLOW_CONSUMER_CLOSE_CODE))
+                    self._close_task.add_done_callback(self._on_close_done)
+            return False
+
+    async def _writer(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                await self.websocket.send_text(text)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.info("[chat-service] Writer for %s:%s stopped: %s", self.user_id, self.device_id, e)
+            self.closed = True
+
+    def _on_close_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("[chat-service] Closing slow consumer %s:%s failed: %s",
+                          self.user_id, self.device_id, task.exception())
+
+    async def close(self, code: int = 1000):
+        if self.closed and self._writer_task is None:
+            return
+        self.closed = True
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        if (
+            self.websocket.client_state != WebSocketState.DISCONNECTED
+            and self.websocket.application_state != WebSocketState.DISCONNECTED
+        ):
+            try:
+                await self.websocket.close(code=code)
+            except Exception:
+                pass
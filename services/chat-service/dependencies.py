@@ -1,19 +1,43 @@
-from datetime import datetime
-from typing import Dict, List
+import asyncio
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
 import json
 from redis.asyncio import Redis
 import httpx
-from sqlalchemy import select
+from sqlalchemy import select, values, column, func, and_, DateTime, Integer
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.orm import aliased
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+from cache import LRUTTLCache, MISSING
+from presence_batcher import PresenceBatcher
+from presence_subscriptions import PresenceSubscriptions
+from archive import archived_months, iter_archived_messages, add_months, month_start
 from models import UsersConversation, Message
 from config import (
     NODE_ID,
     REDIS_HOST,
     REDIS_PORT,
+    REDIS_MESSAGE_WINDOW,
+    REDIS_META_TTL,
+    HOT_REFILL_LOCK_MS,
+    HOT_REFILL_MAX_PENDING,
     DATABASE_URL,
     PRESENCE_SERVICE_URL,
+    NODE_LEASE_TTL,
+    NODE_LEASE_RENEW_INTERVAL,
+    PRESENCE_BATCH_WINDOW,
+    PRESENCE_BATCH_MAX_SIZE,
+    PRESENCE_CACHE_TTL,
+    PRESENCE_CACHE_MAX_ENTRIES,
+    PRESENCE_PUSH_DEBOUNCE,
+    PRESENCE_PUSH_MIN_INTERVAL,
+    PRESENCE_MAX_SUBSCRIPTIONS,
+    CONVERSATION_UPDATES_CHANNEL,
+    MEMBERSHIP_CACHE_TTL,
+    MEMBERSHIP_CACHE_MAX_ENTRIES,
 )
 
 
@@ -35,28 +59,177 @@ async def get_db():
 redis_pool = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
 
+# --- Shared HTTP client for presence-service calls ---
+presence_http_client = httpx.AsyncClient(timeout=5.0)
+
+
+# --- Local presence routing cache ---
+# user_id -> {device_id: node_id} of the user's online devices ({} if none).
+# Entries are dropped when presence-service announces a change for the user on
+# the presence_updates channel, and expire after PRESENCE_CACHE_TTL regardless.
+presence_cache = LRUTTLCache(PRESENCE_CACHE_MAX_ENTRIES, PRESENCE_CACHE_TTL)
+
+
+def on_presence_update(data: str):
+    """
+    presence_updates handler, data is "<user_id>:<device_id>:<status>".
+    """
+    user_id = data.split(":", 1)[0]
+    presence_cache.invalidate(user_id)
+
+
 # --- Presence Lookup ---
 async def get_nodes_for_user(user_id: str):
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(f"{PRESENCE_SERVICE_URL}/presence/{user_id}")
-            if r.status_code == 200:
-                data = r.json()  # should now be a list of device presence records
-                return [entry["node_id"] for entry in data if entry.get("status") == "online"]
-            else:
-                return []
+        r = await presence_http_client.get(f"{PRESENCE_SERVICE_URL}/presence/{user_id}")
+        if r.status_code == 200:
+            data = r.json()  # should now be a list of device presence records
+            return [entry["node_id"] for entry in data if entry.get("status") == "online"]
+        else:
+            return []
     except Exception as e:
         print("[get_nodes_for_user] Presence lookup error:", e)
         return []
 
 
 # --- Fetch Messages from Redis ---
+# chat:{cid}:meta "warm" is set once a set has been refilled from Postgres, so
+# a set that Redis lost (restart, eviction) is refilled on the next read even if
+# persistence-service has started writing new messages to it again.
+def hot_key(conversation_id) -> str:
+    return f"chat:{conversation_id}:messages"
+
+
+def meta_key(conversation_id) -> str:
+    return f"chat:{conversation_id}:meta"
+
+
+def dedupe_messages(messages) -> list:
+    """
+    A refilled set can hold the same message twice (once as written by
+    persistence-service, once as loaded from Postgres); keep the first.
+    """
+    seen = set()
+    unique = []
+    for m in messages:
+        message_id = m.get("id")
+        if message_id is not None:
+            if message_id in seen:
+                continue
+            seen.add(message_id)
+        unique.append(m)
+    return unique
+
+
+async def load_recent_from_db(conversation_id, count) -> list:
+    """
+    Latest `count` messages from Postgres, oldest first, in the same shape as
+    the hot set entries.
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            select(Message)
+            .where(Message.conversation_id == uuid.UUID(str(conversation_id)))
+            .order_by(Message.sent_at.desc(), Message.id.desc())
+            .limit(count)
+        )
+        rows = result.scalars().all()
+    return [
+        {
+            "id": str(m.id),
+            "conversation_id": str(m.conversation_id),
+            "sender_id": str(m.user_id),
+            "content": m.content,
+            "type": m.type,
+            "sent_at": m.sent_at.timestamp(),
+        }
+        for m in reversed(rows)
+    ]
+
+
+# conversation_id -> in-flight refill on this node (single-flight)
+_refills: Dict[str, asyncio.Task] = {}
+
+# Deletes the refill lock only if it still holds this refill's token, so a
+# refill that outlived HOT_REFILL_LOCK_MS can't release another one's lock.
+# KEYS: lock key  ARGV: token
+RELEASE_REFILL_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_refill_lock = redis_pool.register_script(RELEASE_REFILL_LOCK_LUA)
+
+
+def refill_hot_messages(conversation_id: str) -> asyncio.Task:
+    """
+    Starts (or joins) this node's refill of a cold hot set. The task resolves
+    to True once the set is warm, False if another node holds the refill lock
+    or the refill failed. Await it through asyncio.shield.
+    """
+    task = _refills.get(conversation_id)
+    if task is None:
+        task = asyncio.create_task(_refill_hot_messages(conversation_id))
+        _refills[conversation_id] = task
+        task.add_done_callback(lambda _: _refills.pop(conversation_id, None))
+    return task
+
+
+async def _refill_hot_messages(conversation_id: str) -> bool:
+    key = hot_key(conversation_id)
+    meta = meta_key(conversation_id)
+    lock_key = f"chat:{conversation_id}:refill_lock"
+    token = f"{NODE_ID}:{uuid.uuid4().hex}"
+    try:
+        # Across nodes: whoever gets the lock refills, the others read Postgres meanwhile
+        if not await redis_pool.set(lock_key, token, nx=True, px=HOT_REFILL_LOCK_MS):
+            return False
+        window = int(await redis_pool.hget(meta, "window") or REDIS_MESSAGE_WINDOW)
+        messages = await load_recent_from_db(conversation_id, window)
+        complete = len(messages) < window and not await archived_months()
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            if messages:
+                pipe.zadd(key, {json.dumps(m): m["sent_at"] for m in messages})
+            pipe.zremrangebyrank(key, 0, -(window + 1))
+            pipe.hset(meta, "warm", 1)
+            if complete:
+                pipe.hset(meta, "complete", 1)
+            pipe.expire(meta, REDIS_META_TTL)
+            await release_refill_lock(keys=[lock_key], args=[token], client=pipe)
+            await pipe.execute()
+        return True
+    except Exception as e:
+        print(f"[refill_hot_messages] Refill of {conversation_id} failed: {e}")
+        return False
+
+
 async def get_recent_messages(conversation_id, count=50):
+    """
+    Latest `count` messages, oldest first. Served from the hot set when it is
+    warm and holds enough of them; a cold set is refilled first. Otherwise
+    (too few cached, refill running elsewhere, Redis down) read from Postgres.
+    """
+    for attempt in range(2):
+        try:
+            async with redis_pool.pipeline(transaction=False) as pipe:
+                # Extra room for entries that dedupe away after a refill
+                pipe.zrange(hot_key(conversation_id), -2 * count, -1)
+                pipe.hmget(meta_key(conversation_id), "warm", "complete")
+                raw, (warm, complete) = await pipe.execute()
+        except Exception as e:
+            print(f"[get_recent_messages] Redis error: {e}")
+            break
+        messages = dedupe_messages(json.loads(m) for m in raw)[-count:]
+        if warm and (len(messages) >= count or complete):
+            return messages
+        if warm or attempt or not await asyncio.shield(refill_hot_messages(conversation_id)):
+            break
+
     try:
-        messages = await redis_pool.zrange(f"chat:{conversation_id}:messages", -count, -1)
-        return [json.loads(m) for m in messages]
+        return await load_recent_from_db(conversation_id, count)
     except Exception as e:
-        print(f"[get_recent_messages] Redis error: {e}")
+        print(f"[get_recent_messages] DB error: {e}")
         return []
 
 
@@ -73,8 +246,59 @@ async def get_messages_in_time_range(conversation_id, start_time, end_time):
         return []
 
 
+# --- Chat lists (user:{user_id}:conversations, see routes/chat_list.py) ---
+async def update_chat_lists(conversation_id, added=(), removed=(), score: Optional[float] = None):
+    """
+    Keeps members' chat lists in step with membership changes: new members get
+    the conversation (scored `score`, default now, unless already listed),
+    removed members lose it. Message activity is recorded by persistence-service.
+    """
+    if score is None:
+        score = datetime.now(timezone.utc).timestamp()
+    try:
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for user_id in added:
+                pipe.zadd(f"user:{user_id}:conversations", {str(conversation_id): score}, nx=True)
+            for user_id in removed:
+                pipe.zrem(f"user:{user_id}:conversations", str(conversation_id))
+            await pipe.execute()
+    except Exception as e:
+        print(f"[update_chat_lists] Redis error: {e}")
+
+
 # --- Group Membership Lookup ---
+# conversation_id -> [user_id, ...]. Entries are dropped on every node when a
+# conversation is created or its members change (conversation_updates channel),
+# and expire after MEMBERSHIP_CACHE_TTL regardless.
+membership_cache = LRUTTLCache(MEMBERSHIP_CACHE_MAX_ENTRIES, MEMBERSHIP_CACHE_TTL)
+
+
+def on_conversation_update(data: str):
+    """
+    conversation_updates handler, data is the conversation_id.
+    """
+    membership_cache.invalidate(data)
+
+
+async def publish_conversation_update(conversation_id: str):
+    """
+    Tells every chat node (this one included) that the members of
+    conversation_id changed.
+    """
+    membership_cache.invalidate(str(conversation_id))
+    try:
+        await redis_pool.publish(CONVERSATION_UPDATES_CHANNEL, str(conversation_id))
+    except Exception as e:
+        print(f"[publish_conversation_update] Redis error: {e}")
+
+
 async def get_group_members(conversation_id: str):
+    conversation_id = str(conversation_id)
+    user_ids = membership_cache.get(conversation_id)
+    if user_ids is not MISSING:
+        return user_ids
+
+    generation = membership_cache.generation
     async with AsyncSessionLocal() as session:
         stmt = select(UsersConversation.user_id).where(
             UsersConversation.conversation_id == conversation_id
@@ -82,130 +306,428 @@ async def get_group_members(conversation_id: str):
         result = await session.execute(stmt)
         members = result.scalars().all()
         user_ids = [str(uid) for uid in members]
-        print(f"[get_group_members] Members of {conversation_id}: {user_ids}")
-        return user_ids
+    membership_cache.set(conversation_id, user_ids, generation=generation)
+    return user_ids
 
 
 # --- Presence Status Update --- 
-async def update_presence_status(user_id: str, status: str, device_id: str):
+# --- Node lease ---
+# Identifies this process: devices registered by a previous run of the same
+# NODE_ID (e.g. before a crash) don't match it and are not routed here
+NODE_EPOCH = uuid.uuid4().hex
+
+
+async def renew_node_lease() -> bool:
+    try:
+        response = await presence_http_client.put(
+            f"{PRESENCE_SERVICE_URL}/presence/nodes/{NODE_ID}/lease",
+            json={"epoch": NODE_EPOCH, "ttl": NODE_LEASE_TTL},
+        )
+        if response.status_code == 200:
+            return True
+        print(f"[renew_node_lease] Failed ({response.status_code}): {response.text}")
+    except Exception as e:
+        print(f"[renew_node_lease] Error: {e}")
+    return False
+
+
+async def node_lease_loop():
+    """
+    Keeps this node's lease alive; several renewals fit in one NODE_LEASE_TTL
+    so a single failed request doesn't drop the node.
+    """
+    while True:
+        await renew_node_lease()
+        await asyncio.sleep(NODE_LEASE_RENEW_INTERVAL)
+
+
+async def release_node_lease():
+    try:
+        await presence_http_client.delete(
+            f"{PRESENCE_SERVICE_URL}/presence/nodes/{NODE_ID}/lease",
+            params={"epoch": NODE_EPOCH},
+        )
+    except Exception as e:
+        print(f"[release_node_lease] Error: {e}")
+
+
+async def send_presence_batch(status: str, devices: List[tuple]):
     payload = {
-        "user_id": user_id,
-        "device_id": device_id,
-        "node_id": NODE_ID,
-        "status": status
+        "devices": [
+            {
+                "user_id": user_id,
+                "device_id": device_id,
+                "node_id": NODE_ID,
+                "node_epoch": NODE_EPOCH,
+                "status": status,
+            }
+            for user_id, device_id in devices
+        ]
     }
     url = (
-        f"{PRESENCE_SERVICE_URL}/presence/online"
+        f"{PRESENCE_SERVICE_URL}/presence/online/batch"
         if status == "online"
-        else f"{PRESENCE_SERVICE_URL}/presence/offline"
+        else f"{PRESENCE_SERVICE_URL}/presence/offline/batch"
     )
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload)
-            if response.status_code == 200:
-                print(f"[update_presence_status] {user_id}:{device_id} marked as {status}")
-            else:
-                print(f"[update_presence_status] Failed ({response.status_code}): {response.text}")
+        response = await presence_http_client.post(url, json=payload)
+        if response.status_code == 200:
+            print(f"[update_presence_status] {len(devices)} device(s) marked as {status}")
+        else:
+            print(f"[update_presence_status] Failed ({response.status_code}): {response.text}")
     except Exception as e:
         print(f"[update_presence_status] Error: {e}")
 
 
+# A reconnect storm of N devices costs about N / PRESENCE_BATCH_MAX_SIZE calls
+# (one Redis pipeline each) instead of N
+presence_batcher = PresenceBatcher(send_presence_batch, PRESENCE_BATCH_WINDOW, PRESENCE_BATCH_MAX_SIZE)
+
+
+async def update_presence_status(user_id: str, status: str, device_id: str):
+    """
+    Queues the device's new status and waits until its batch has been sent.
+    """
+    await presence_batcher.submit(user_id, device_id, status)
+
+
 async def get_devices_for_user(user_id: str) -> dict:
     """
     Returns {device_id: node_id} for all devices of user_id that are 'online'.
     """
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(f"{PRESENCE_SERVICE_URL}/presence/{user_id}")
-            if r.status_code == 200:
-                data = r.json()
-                return {
-                    entry["device_id"]: entry["node_id"]
-                    for entry in data
-                    if entry.get("status") == "online"
-                }
-            else:
-                return {}
+        r = await presence_http_client.get(f"{PRESENCE_SERVICE_URL}/presence/{user_id}")
+        if r.status_code == 200:
+            data = r.json()
+            return {
+                entry["device_id"]: entry["node_id"]
+                for entry in data
+                if entry.get("status") == "online"
+            }
+        else:
+            return {}
     except Exception as e:
         print("[get_devices_for_user] Error:", e)
         return {}
 
 
+async def fetch_node_map(user_ids: List[str]) -> Optional[Dict[str, List[Dict[str, str]]]]:
+    """
+    Calls presence-service's /presence/nodes endpoint for user_ids.
+    Returns None if presence-service could not be reached.
+    """
+    try:
+        resp = await presence_http_client.get(
+            f"{PRESENCE_SERVICE_URL}/presence/nodes",
+            params={"user_ids": ",".join(user_ids)},
+        )
+        if resp.status_code == 200:
+            return resp.json()  # This is the node_map from presence-service
+        print(f"[fetch_node_map] Error {resp.status_code}: {resp.text}")
+    except Exception as e:
+        print("[fetch_node_map] Exception:", e)
+    return None
+
+
+async def get_device_maps(user_ids: List[str], strict: bool = False) -> Dict[str, Dict[str, str]]:
+    """
+    Returns user_id -> {device_id: node_id} for the online devices of user_ids.
+    Served from presence_cache; all misses are resolved with one /presence/nodes call.
+    If presence-service can't be reached, misses come back as {} (no devices),
+    or raise ConnectionError with strict=True.
+    """
+    device_maps = {}
+    missing = []
+    for user_id in user_ids:
+        devices = presence_cache.get(user_id)
+        if devices is MISSING:
+            missing.append(user_id)
+        else:
+            device_maps[user_id] = devices
+
+    if missing:
+        generation = presence_cache.generation
+        node_map = await fetch_node_map(missing)
+        if node_map is None and strict:
+            raise ConnectionError("presence-service unreachable")
+        fetched = {user_id: {} for user_id in missing}
+        for node_id, devices in (node_map or {}).items():
+            for entry in devices:
+                fetched.setdefault(entry["user_id"], {})[entry["device_id"]] = node_id
+        for user_id, devices in fetched.items():
+            if node_map is not None:
+                presence_cache.set(user_id, devices, generation=generation)
+            device_maps[user_id] = devices
+
+    return device_maps
+
+
 async def get_node_map_for_users(
     user_ids: List[str],
     sender_id: str = None,
     origin_device_id: str = None
 ) -> Dict[str, List[Dict[str, str]]]:
     """
-    Calls presence-service's /presence/nodes endpoint with user_ids,
-    plus optionally sender_id & origin_device_id, and returns the
-    node_id -> [ {user_id, device_id}, ... ] structure.
+    Returns the node_id -> [ {user_id, device_id}, ... ] structure for the
+    online devices of user_ids, leaving out the sender's origin device.
+    Steady-state lookups are answered from the local presence cache.
     """
     if not user_ids:
         return {}
 
-    base_url = f"{PRESENCE_SERVICE_URL}/presence/nodes"
-    # Build query params
-    params = {
-        "user_ids": ",".join(user_ids)
+    node_map = {}
+    for user_id, devices in (await get_device_maps(user_ids)).items():
+        for device_id, node_id in devices.items():
+            if user_id == sender_id and device_id == origin_device_id:
+                continue
+            node_map.setdefault(node_id, []).append({
+                "user_id": user_id,
+                "device_id": device_id
+            })
+    return node_map
+
+
+# --- Synchronize Messages from Redis or Redis + Postgres---
+def format_db_message(m: Message) -> dict:
+    return {
+        "id": str(m.id),
+        "conversation_id": str(m.conversation_id),
+        "user_id": str(m.user_id),
+        "content": m.content,
+        "type": m.type,
+        "sent_at": m.sent_at.timestamp()
     }
-    if sender_id:
-        params["sender_id"] = sender_id
-    if origin_device_id:
-        params["origin_device_id"] = origin_device_id
 
+
+async def sync_conversations(conversation_ids: List[str], since: float, limit=100) -> Dict[str, list]:
+    """
+    Batched sync for many conversations in a constant number of round trips:
+    one pipelined ZRANGEBYSCORE over every hot-store key, then one Postgres
+    query that applies each conversation's own lower bound and remaining limit
+    with row_number() partitioned by conversation_id.
+
+    Returns conversation_id -> messages (oldest first), per conversation the
+    same as sync_messages.
+    """
+    valid_ids = []
+    for cid in conversation_ids:
+        try:
+            uuid.UUID(str(cid))
+            valid_ids.append(str(cid))
+        except ValueError:
+            print(f"[sync_conversations] Skipping invalid conversation id: {cid}")
+    if not valid_ids:
+        return {}
+
+    # Step 1: Try Redis first, all conversations in one round trip. A hot set
+    # only answers for its conversation if it is warm and either reaches back
+    # to `since` or holds the whole conversation; otherwise Postgres covers the
+    # full range. Cold sets are refilled in the background for the next read,
+    # at most HOT_REFILL_MAX_PENDING at a time on this node; the rest are
+    # picked up by a later read.
+    cold = []
+    redis_messages = {}
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(base_url, params=params)
-            if resp.status_code == 200:
-                return resp.json()  # This is the node_map from presence-service
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for cid in valid_ids:
+                pipe.zrangebyscore(hot_key(cid), min=since, max=9999999999)
+                pipe.zrange(hot_key(cid), 0, 0, withscores=True)
+                pipe.hmget(meta_key(cid), "warm", "complete")
+            raw_results = await pipe.execute()
+        for i, cid in enumerate(valid_ids):
+            raw, oldest, (warm, complete) = raw_results[3 * i:3 * i + 3]
+            if not warm:
+                cold.append(cid)
+            if warm and (complete or (oldest and oldest[0][1] <= since)):
+                redis_messages[cid] = dedupe_messages(json.loads(m) for m in raw)
             else:
-                print(f"[get_node_map_for_users] Error {resp.status_code}: {resp.text}")
-                return {}
+                redis_messages[cid] = []
     except Exception as e:
-        print("[get_node_map_for_users] Exception:", e)
-        return {}
+        print(f"[sync_conversations] Redis error: {e}")
+        redis_messages = {cid: [] for cid in valid_ids}
+    for cid in cold:
+        if cid not in _refills and len(_refills) >= HOT_REFILL_MAX_PENDING:
+            break
+        refill_hot_messages(cid)
+
+    # Step 2: A sync reaching back past the retention window starts in the
+    # cold archive, for the conversations Redis couldn't answer
+    archived_messages = {cid: [] for cid in valid_ids}
+    since_dt = datetime.fromtimestamp(since, timezone.utc)
+    months = await archived_months()
+    if months and month_start(add_months(months[-1], 1)) > since_dt:
+        for cid in valid_ids:
+            if redis_messages[cid]:
+                continue
+            async for m in iter_archived_messages(cid, after=since_dt):
+                m["sent_at"] = datetime.fromisoformat(m["sent_at"]).timestamp()
+                archived_messages[cid].append(m)
+                if len(archived_messages[cid]) >= limit:
+                    break
+
+    # Step 3: Per conversation, Postgres only has to cover what is newer than
+    # the latest Redis message, up to whatever is left of the limit
+    bounds = []
+    for cid, messages in redis_messages.items():
+        remaining = limit - len(messages) - len(archived_messages[cid])
+        if remaining <= 0:
+            continue
+        latest_ts = since
+        if messages:
+            try:
+                latest_ts = messages[-1]["sent_at"]
+            except (KeyError, TypeError) as e:
+                print(f"[sync_conversations] Malformed Redis message: {e}")
+        bounds.append((uuid.UUID(cid), datetime.fromtimestamp(latest_ts, timezone.utc), remaining))
+
+    db_messages = {cid: [] for cid in valid_ids}
+    if bounds:
+        bounds_table = values(
+            column("conversation_id", PG_UUID(as_uuid=True)),
+            column("after", DateTime(timezone=True)),
+            column("remaining", Integer),
+            name="bounds",
+        ).data(bounds)
+        ranked = (
+            select(
+                Message,
+                func.row_number().over(
+                    partition_by=Message.conversation_id,
+                    order_by=Message.sent_at.asc(),
+                ).label("rn"),
+                bounds_table.c.remaining,
+            )
+            .join(
+                bounds_table,
+                and_(
+                    Message.conversation_id == bounds_table.c.conversation_id,
+                    Message.sent_at > bounds_table.c.after,
+                ),
+            )
+            .subquery()
+        )
+        ranked_message = aliased(Message, ranked)
+        stmt = (
+            select(ranked_message)
+            .where(ranked.c.rn <= ranked.c.remaining)
+            .order_by(ranked.c.conversation_id, ranked.c.sent_at.asc())
+        )
+        try:
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(stmt)
+                for m in result.scalars().all():
+                    db_messages[str(m.conversation_id)].append(format_db_message(m))
+        except Exception as e:
+            print(f"[sync_conversations] DB error: {e}")
+
+    # Step 4: Combine them
+    synced = {}
+    for cid in valid_ids:
+        combined = dedupe_messages(archived_messages[cid] + redis_messages[cid] + db_messages[cid])
+        combined.sort(key=lambda x: x["sent_at"])  # Optional: sort if needed
+        synced[cid] = combined
+    return synced
 
 
-# --- Synchronize Messages from Redis or Redis + Postgres---
 async def sync_messages(conversation_id: str, user_id: str, since: float, limit=100):
-    # Step 1: Try Redis first
-    redis_messages = await get_messages_in_time_range(conversation_id, since, end_time=9999999999)
+    synced = await sync_conversations([conversation_id], since, limit)
+    return synced.get(str(conversation_id), [])
 
-    # Update "since" to latest message in Redis to avoid overlap
+
+# --- Per-user inbox stream (written by persistence-service) ---
+def parse_stream_id(stream_id: str):
+    """
+    "1700000000000-3" -> (1700000000000, 3). Raises ValueError if malformed.
+    """
+    ms, _, seq = str(stream_id).partition("-")
+    return int(ms), int(seq or 0)
+
+
+def inbox_key(user_id: str) -> str:
+    return f"inbox:{user_id}"
+
+
+def inbox_epoch_key(user_id: str) -> str:
+    # Id of the first entry of the current inbox stream, set by persistence-service
+    return f"inbox:{user_id}:epoch"
+
+
+async def get_inbox_head(user_id: str) -> Optional[str]:
+    """
+    inbox_id ("<epoch>:<stream id>") of the newest entry in the user's inbox
+    (stream id "0-0" if it is empty), which a client can pass back as since_id
+    after a full sync. None if Redis is unavailable.
+    """
     try:
-        latest_redis_ts = redis_messages[-1]["sent_at"]
-    except (KeyError, TypeError, IndexError) as e:
-        print(f"[sync_messages] Malformed Redis message: {e}")
-        latest_redis_ts = since
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            pipe.get(inbox_epoch_key(user_id))
+            pipe.xrevrange(inbox_key(user_id), count=1)
+            epoch, entries = await pipe.execute()
+    except Exception as e:
+        print(f"[get_inbox_head] Redis error: {e}")
+        return None
+    return f"{epoch or '0-0'}:{entries[0][0] if entries else '0-0'}"
 
 
-    # Step 2: Query Postgres ONLY for messages newer than the latest Redis one
-    async with AsyncSessionLocal() as session:
-        stmt = (
-            select(Message)
-            .where(Message.conversation_id == conversation_id)
-            .where(Message.sent_at > datetime.fromtimestamp(latest_redis_ts))
-            .order_by(Message.sent_at.asc())
-            .limit(limit - len(redis_messages))
-        )
-        result = await session.execute(stmt)
-        db_messages = result.scalars().all()
+async def read_inbox(user_id: str, since_id: str):
+    """
+    Reads the user's inbox entries after since_id (an inbox_id).
 
-        db_formatted = [
-            {
-                "id": str(m.id),
-                "conversation_id": str(m.conversation_id),
-                "user_id": str(m.user_id),
-                "content": m.content,
-                "type": m.type,
-                "sent_at": m.sent_at.timestamp()
-            }
-            for m in db_messages
-        ]
+    Returns (conversation ids that changed, in order of first appearance,
+    inbox_id of the last entry read), or None if the inbox can't answer: the
+    stream is missing or isn't the one since_id was issued for (Redis lost
+    and recreated it), entries after since_id have been trimmed away, or
+    Redis is unavailable. The caller then falls back to a full sync.
+    Raises ValueError if since_id is malformed.
+    """
+    epoch, sep, stream_id = since_id.partition(":")
+    if not sep:
+        # Issued before inbox epochs: can't tell which stream it belongs to
+        return None
+    parse_stream_id(epoch)
+    since = parse_stream_id(stream_id)
+    key = inbox_key(user_id)
+    try:
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            pipe.get(inbox_epoch_key(user_id))
+            pipe.exists(key)
+            pipe.xrange(key, min=f"({since[0]}-{since[1]}", max="+")
+            current_epoch, exists, entries = await pipe.execute()
+        if not exists or current_epoch != epoch:
+            return None
+        info = await redis_pool.xinfo_stream(key)
+    except Exception as e:
+        print(f"[read_inbox] Redis error: {e}")
+        return None
+
+    # MAXLEN trimming only ever removes the oldest entries, so if anything was
+    # trimmed (entries-added > length; always assumed before Redis 7) and
+    # since_id is older than the first remaining entry, entries may be missing
+    first_entry = info.get("first-entry")
+    entries_added = info.get("entries-added")
+    trimmed = entries_added is None or int(entries_added) > int(info["length"])
+    if trimmed and first_entry and since < parse_stream_id(first_entry[0]):
+        return None
 
-    # Step 3: Combine the two — no overlap = no dedup needed
-    combined = redis_messages + db_formatted
-    combined.sort(key=lambda x: x["sent_at"])  # Optional: sort if needed
+    changed = {}
+    last_id = stream_id
+    for entry_id, fields in entries:
+        changed.setdefault(fields.get("c"), None)
+        last_id = entry_id
+    changed.pop(None, None)
+    return list(changed), f"{epoch}:{last_id}"
 
-    return combined
\ No newline at end of file
+
+# --- Presence subscriptions (pushed to WebSocket clients) ---
+async def resolve_watched_devices(user_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    return await get_device_maps(user_ids, strict=True)
+
+
+presence_subscriptions = PresenceSubscriptions(
+    resolve_watched_devices,
+    debounce=PRESENCE_PUSH_DEBOUNCE,
+    min_interval=PRESENCE_PUSH_MIN_INTERVAL,
+    max_per_connection=PRESENCE_MAX_SUBSCRIPTIONS,
+    # presence_cache entries live this long, so a lease expiry shows up within about twice that
+    recheck_interval=PRESENCE_CACHE_TTL,
+)
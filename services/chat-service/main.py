@@ -4,15 +4,32 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from models import Base
-
-from dependencies import async_engine as engine
+from migrations import run_migrations
+
+from dependencies import (
+    async_engine as engine,
+    presence_cache,
+    presence_http_client,
+    presence_batcher,
+    presence_subscriptions,
+    renew_node_lease,
+    node_lease_loop,
+    release_node_lease,
+    on_presence_update,
+    membership_cache,
+    on_conversation_update,
+)
 
 from routes.conversations import router as convo_router
 from routes.websocket import router as websocket_router
 from routes.message_read import router as message_read_router
+from routes.unread import router as unread_router
+from routes.chat_list import router as chat_list_router
 
-from config import APP_ENV
+from config import APP_ENV, PRESENCE_UPDATES_CHANNEL, CONVERSATION_UPDATES_CHANNEL
 from message_transport.consumer import consumer_loop
+from redis_events import subscribe, redis_events_loop
+from archive import archive_loop
 
 
 
@@ -24,10 +41,26 @@ async def lifespan(app: FastAPI):
         print("[chat-service] Running in development mode: Creating tables...")
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+    await run_migrations(engine)
+
+    print("[chat-service] Taking node lease in presence-service...")
+    await renew_node_lease()
+    app.state.lease_task = asyncio.create_task(node_lease_loop())
+    presence_batcher.start()
 
     print("[chat-service] Starting aio-pika consumer task...")
     app.state.consumer_task = asyncio.create_task(consumer_loop())
 
+    print("[chat-service] Starting Redis pub/sub listener...")
+    subscribe(PRESENCE_UPDATES_CHANNEL, on_presence_update, on_reset=presence_cache.clear)
+    subscribe(PRESENCE_UPDATES_CHANNEL, presence_subscriptions.on_presence_update, on_reset=presence_subscriptions.mark_all_due)
+    subscribe(CONVERSATION_UPDATES_CHANNEL, on_conversation_update, on_reset=membership_cache.clear)
+    app.state.events_task = asyncio.create_task(redis_events_loop())
+    presence_subscriptions.start()
+
+    print("[chat-service] Starting message archiver...")
+    app.state.archive_task = asyncio.create_task(archive_loop(engine))
+
     yield
 
     print("[chat-service] Shutting down consumer task...")
@@ -37,12 +70,22 @@ async def lifespan(app: FastAPI):
     except asyncio.CancelledError:
         print("[chat-service] Consumer task cancelled.")
 
+    app.state.events_task.cancel()
+    await presence_subscriptions.close()
+    app.state.archive_task.cancel()
+    app.state.lease_task.cancel()
+    await presence_batcher.close()
+    await release_node_lease()
+    await presence_http_client.aclose()
+
 
 # Initialize FastAPI app with lifespan manager
 app = FastAPI(lifespan=lifespan)
 app.include_router(websocket_router)
 app.include_router(convo_router)
 app.include_router(message_read_router)
+app.include_router(unread_router)
+app.include_router(chat_list_router)
 
 @app.get("/")
 async def health_check():
@@ -50,5 +93,16 @@ async def health_check():
     return {"status": "chat-service OK"}
 
 
+@app.get("/stats")
+async def stats():
+    """Node-local cache counters."""
+    return {
+        "presence_cache": presence_cache.stats(),
+        "membership_cache": membership_cache.stats(),
+        "presence_batcher": presence_batcher.stats(),
+        "presence_subscriptions": presence_subscriptions.stats(),
+    }
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8002, reload=True)
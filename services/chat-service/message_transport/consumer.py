@@ -1,7 +1,7 @@
 import json
 import asyncio
 import logging
-from typing import Optional
+from typing import List, Optional, Tuple
 from aio_pika import connect_robust, ExchangeType, IncomingMessage
 from aio_pika.exceptions import AMQPConnectionError
 from aio_pika.abc import (
@@ -11,12 +11,14 @@ from aio_pika.abc import (
     AbstractQueue,
 )
 from routes.websocket import connected_users
+from message_transport.envelope import is_envelope, unpack
 from fastapi.websockets import WebSocketState
 from config import (
     EXCHANGE_NAME,
     NODE_ID,
     RABBIT_HOST,
     RABBIT_PORT,
+    CONSUMER_PREFETCH,
 )
 
 # --- Connection globals ---
@@ -33,6 +35,7 @@ async def get_consumer_connection():
     if not consumer_channel or consumer_channel.is_closed:
         logging.info("[chat-consumer] Establishing a new channel...")
         consumer_channel = await consumer_connection.channel()
+        await consumer_channel.set_qos(prefetch_count=CONSUMER_PREFETCH)
     if not consumer_exchange or consumer_exchange.is_closed:
         logging.info("[chat-consumer] Declaring the exchange...")
         consumer_exchange = await consumer_channel.declare_exchange(
@@ -67,8 +70,10 @@ async def consumer_loop():
 
 async def on_message(message: IncomingMessage):
     """
-    Each message is a Node Message intended for this node.
-    We expect: {
+    Each message is a Node Message intended for this node, normally an envelope
+    (see message_transport/envelope.py) carrying the target devices in its header
+    and the client payload as pre-encoded bytes. The legacy JSON form is still
+    accepted: {
       "event_type": "chat_message",
       "payload": {...},
       "target_devices": [
@@ -76,47 +81,69 @@ async def on_message(message: IncomingMessage):
          ...
       ]
     }
-    We deliver 'payload' to each local device's websocket (if connected).
+    The payload is queued to each local device's connection (if connected),
+    whose writer task does the socket send, and the message is then acked.
+    Queuing never waits, so this runs before the handler's first await and a
+    conversation's messages reach each device in the order they were received.
     """
-    msg_str = message.body.decode("utf-8")
-    print(f"[chat-consumer] Received raw message: {msg_str}")
+    logging.debug("[chat-consumer] Received node message (%s bytes)", len(message.body))
 
     try:
-        node_msg = json.loads(msg_str)
-    except json.JSONDecodeError as e:
-        print(f"[chat-consumer] JSON parse error: {e}")
+        if is_envelope(message.body):
+            event_type, _, targets, payload = unpack(message.body)
+            # Decoded once per node message, never parsed
+            payload_text = payload.decode("utf-8")
+        else:
+            node_msg = json.loads(message.body)
+            event_type = node_msg.get("event_type")
+            payload = node_msg.get("payload")
+            targets = [
+                (t.get("user_id"), t.get("device_id"))
+                for t in node_msg.get("target_devices", [])
+            ]
+            payload_text = json.dumps(payload)
+    except (ValueError, UnicodeDecodeError) as e:
+        print(f"[chat-consumer] Node message parse error: {e}")
         await message.ack()
         return
 
     # Basic validation
-    event_type = node_msg.get("event_type")
-    payload = node_msg.get("payload")
-    targets = node_msg.get("target_devices", [])
-
     if event_type != "chat_message" or not payload or not targets:
         print("[chat-consumer] Invalid node message format. Acknowledging.")
         await message.ack()
         return
 
-    # Deliver to each device in 'target_devices'
-    for t in targets:
-        user_id = t.get("user_id")
-        device_id = t.get("device_id")
+    try:
+        deliver_to_local_devices(payload_text, targets)
+    except Exception as e:
+        logging.error("[chat-consumer] Delivery error: %s", e)
+    # Ack only once delivery has been attempted
+    try:
+        await message.ack()
+    except Exception as e:
+        logging.error("[chat-consumer] Ack error: %s", e)
+
+def deliver_to_local_devices(payload_text: str, targets: List[Tuple[str, str]]) -> int:
+    """
+    Queues the already-encoded payload to each (user_id, device_id) target
+    connected to this node. Returns how many devices it was queued for.
+    """
+    # Each device's writer task does the actual socket send, so queuing to every
+    # local target is immediate and nobody waits on a slow socket.
+    delivered = 0
+    for user_id, device_id in targets:
         if not user_id or not device_id:
             continue
 
         user_sockets = connected_users.get(user_id)
         if not user_sockets:
             continue  # user not connected at all on this node
-        ws = user_sockets.get(device_id)
-        if not ws:
+        connection = user_sockets.get(device_id)
+        if not connection:
             continue  # that device not connected
 
-        # Attempt to send
-        try:
-            await ws.send_text(json.dumps(payload))
-            print(f"[chat-consumer] Delivered to {user_id}:{device_id}")
-        except Exception as e:
-            print(f"[chat-consumer] Delivery error to {user_id}:{device_id} -> {e}")
+        if connection.send(payload_text):
+            delivered += 1
 
-    await message.ack()
+    logging.debug("[chat-consumer] Queued message for %s/%s local device(s)", delivered, len(targets))
+    return delivered
@@ -0,0 +1,64 @@
+"""
+Node-message envelope shared by the producer, persistor and consumer.
+
+The client-facing payload is JSON-encoded exactly once, when chat-service
+accepts a message. From then on it travels as opaque bytes: the persistor
+publishes them as-is, and the producer wraps them for each node as
+
+    MAGIC (2 bytes) | header length (uint32, big endian) | header | payload
+
+where the header is a small compact-JSON object holding only what the consumer
+needs for routing:
+
+    {"e": event_type, "c": conversation_id, "t": [[user_id, device_id], ...]}
+
+The consumer reads the header and forwards the payload bytes to sockets without
+ever parsing them.
+"""
+import json
+import struct
+from typing import List, Tuple
+
+MAGIC = b"\xceE"
+_LENGTH = struct.Struct(">I")
+_PREFIX_SIZE = len(MAGIC) + _LENGTH.size
+
+
+def encode_payload(message_dict: dict) -> bytes:
+    return json.dumps(message_dict, separators=(",", ":")).encode("utf-8")
+
+
+def pack(event_type: str, conversation_id: str, targets: List[dict], payload: bytes) -> bytes:
+    """
+    Wraps pre-encoded payload bytes for one node. `targets` is the presence
+    device list, [{"user_id": ..., "device_id": ...}, ...].
+    """
+    header = json.dumps(
+        {
+            "e": event_type,
+            "c": str(conversation_id),
+            "t": [[t["user_id"], t["device_id"]] for t in targets],
+        },
+        separators=(",", ":"),
+    ).encode("utf-8")
+    return b"".join((MAGIC, _LENGTH.pack(len(header)), header, payload))
+
+
+def is_envelope(body: bytes) -> bool:
+    return body[:len(MAGIC)] == MAGIC
+
+
+def unpack(body: bytes) -> Tuple[str, str, List[Tuple[str, str]], bytes]:
+    """
+    Returns (event_type, conversation_id, [(user_id, device_id), ...], payload bytes).
+    Raises ValueError if body is not a well-formed envelope.
+    """
+    if not is_envelope(body) or len(body) < _PREFIX_SIZE:
+        raise ValueError("not a node-message envelope")
+    (header_len,) = _LENGTH.unpack_from(body, len(MAGIC))
+    header_end = _PREFIX_SIZE + header_len
+    if len(body) < header_end:
+        raise ValueError("truncated node-message envelope")
+    header = json.loads(body[_PREFIX_SIZE:header_end])
+    targets = [(user_id, device_id) for user_id, device_id in header.get("t", [])]
+    return header.get("e"), header.get("c", ""), targets, body[header_end:]
@@ -1,26 +1,40 @@
 import json
+import asyncio
 from aio_pika import connect_robust, ExchangeType, Message, DeliveryMode
 from typing import Optional
 from aio_pika.abc import AbstractExchange
 
-from config import RABBIT_HOST, RABBIT_PORT
+from config import RABBIT_HOST, RABBIT_PORT, PUBLISH_CONFIRM_TIMEOUT
 
 
 _persistence_exchange: Optional[AbstractExchange] = None
+_persistence_lock = asyncio.Lock()
 
 
 async def send_to_persistence_queue(msg_data):
+    """
+    msg_data is the message dict, or the same message already JSON-encoded.
+
+    Returns once the broker has confirmed the message (the channel has
+    publisher confirms on); raises if it is nacked or not confirmed within
+    PUBLISH_CONFIRM_TIMEOUT, so the client is never acked for a message the
+    broker didn't take.
+    """
     global _persistence_exchange
 
     if not _persistence_exchange:
-        connection = await connect_robust(host=RABBIT_HOST, port=RABBIT_PORT)
-        channel = await connection.channel()
-        _persistence_exchange = await channel.declare_exchange(
-            "persistence-exchange", ExchangeType.DIRECT, durable=True
-        )
+        # Connections now publish concurrently; only the first one sets up the exchange
+        async with _persistence_lock:
+            if not _persistence_exchange:
+                connection = await connect_robust(host=RABBIT_HOST, port=RABBIT_PORT)
+                channel = await connection.channel(publisher_confirms=True)
+                _persistence_exchange = await channel.declare_exchange(
+                    "persistence-exchange", ExchangeType.DIRECT, durable=True
+                )
 
-    body = json.dumps(msg_data).encode()
+    body = msg_data if isinstance(msg_data, bytes) else json.dumps(msg_data).encode()
     await _persistence_exchange.publish(
         Message(body, delivery_mode=DeliveryMode.PERSISTENT),
         routing_key="store",
+        timeout=PUBLISH_CONFIRM_TIMEOUT,
     )
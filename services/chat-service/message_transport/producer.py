@@ -1,41 +1,61 @@
-import json
+import asyncio
 import logging
-from typing import Optional
-from fastapi import HTTPException
+from typing import Dict, Optional
 from aio_pika import connect_robust, Message, DeliveryMode, ExchangeType
 from aio_pika.abc import (
     AbstractRobustConnection,
     AbstractChannel,
-    AbstractExchange,
 )
-from config import RABBIT_HOST, RABBIT_PORT, EXCHANGE_NAME
+from aio_pika.pool import Pool
+from config import (
+    RABBIT_HOST,
+    RABBIT_PORT,
+    EXCHANGE_NAME,
+    PUBLISHER_CHANNEL_POOL_SIZE,
+    PUBLISH_CONFIRM_TIMEOUT,
+)
 from dependencies import get_group_members, get_node_map_for_users
+from message_transport.envelope import encode_payload, pack
 
 publisher_connection: Optional[AbstractRobustConnection] = None
-publisher_channel: Optional[AbstractChannel] = None
-publisher_exchange: Optional[AbstractExchange] = None
+# Confirm-enabled publisher channels, shared by all WebSocket handlers on this node
+publisher_channel_pool: Optional[Pool] = None
 
 async def get_publisher_connection():
-    global publisher_connection, publisher_channel, publisher_exchange
+    global publisher_connection
     if not publisher_connection or publisher_connection.is_closed:
         logging.info("[RabbitMQ] Establishing a new publisher connection...")
         publisher_connection = await connect_robust(host=RABBIT_HOST, port=RABBIT_PORT)
-    if not publisher_channel or publisher_channel.is_closed:
-        logging.info("[RabbitMQ] Establishing a new publisher channel...")
-        publisher_channel = await publisher_connection.channel()
-    if not publisher_exchange:
-        logging.info("[RabbitMQ] Declaring the publisher exchange...")
-        publisher_exchange = await publisher_channel.declare_exchange(
-            EXCHANGE_NAME, ExchangeType.DIRECT, durable=True
-        )
-    return publisher_connection, publisher_channel, publisher_exchange
+    return publisher_connection
+
+async def create_publisher_channel() -> AbstractChannel:
+    connection = await get_publisher_connection()
+    logging.info("[RabbitMQ] Establishing a new publisher channel...")
+    channel = await connection.channel(publisher_confirms=True)
+    await channel.declare_exchange(EXCHANGE_NAME, ExchangeType.DIRECT, durable=True)
+    return channel
+
+def get_publisher_channel_pool() -> Pool:
+    global publisher_channel_pool
+    if publisher_channel_pool is None:
+        publisher_channel_pool = Pool(create_publisher_channel, max_size=PUBLISHER_CHANNEL_POOL_SIZE)
+    return publisher_channel_pool
 
-async def distribute_message(message_dict: dict):
+async def distribute_message(message_dict: dict, payload: Optional[bytes] = None) -> Dict[str, object]:
     """
     1) Determine recipient user_ids (self, 1-on-1, or group).
-    2) Let presence-service do the node-level grouping (GET /presence/nodes).
-    3) Publish one Node Message per node to RabbitMQ.
+    2) Resolve the node-level grouping (local presence cache / presence-service).
+    3) Publish one Node Message per node to RabbitMQ, all at once, and wait for
+       the broker to confirm them together.
+
+    `payload` is message_dict already encoded for clients (encoded here if not
+    given); it is wrapped per node without being re-serialized.
+
+    Returns the outcome for this message:
+      {"published": [node_id, ...], "failed": {node_id: reason, ...}}
     """
+    outcome = {"published": [], "failed": {}}
+
     conversation_id = message_dict["conversation_id"]
     sender_id = message_dict["sender_id"]
     origin_device_id = message_dict.get("origin_device_id")
@@ -53,7 +73,7 @@ async def distribute_message(message_dict: dict):
         members = await get_group_members(conversation_id)
         all_recipients = set(members)
 
-    # Bulk node map call to presence-service
+    # Bulk node map lookup
     node_map = await get_node_map_for_users(
         user_ids=list(all_recipients),
         sender_id=sender_id,
@@ -61,32 +81,40 @@ async def distribute_message(message_dict: dict):
     )
 
     if not node_map:
-        logging.warning("[distribute_message] presence-service returned empty node_map.")
-        return
+        logging.debug("[distribute_message] No online recipient devices.")
+        return outcome
 
+    # node_map looks like: {"node1": [{"user_id":..., "device_id":...}, ...], "node2": [...]}
+    node_ids = list(node_map)
+    if payload is None:
+        payload = encode_payload(message_dict)
     try:
-        _, _, exchange = await get_publisher_connection()
-
-        # node_map looks like: {"node1": [{"user_id":..., "device_id":...}, ...], "node2": [...]}
-        for node_id, device_list in node_map.items():
-            node_msg = {
-                "event_type": "chat_message",
-                "payload": message_dict,
-                "target_devices": device_list
-            }
-            body_str = json.dumps(node_msg)
-
-            await exchange.publish(
-                Message(
-                    body_str.encode("utf-8"),
-                    delivery_mode=DeliveryMode.PERSISTENT
+        async with get_publisher_channel_pool().acquire() as channel:
+            exchange = await channel.get_exchange(EXCHANGE_NAME, ensure=False)
+            results = await asyncio.gather(
+                *(
+                    exchange.publish(
+                        Message(
+                            pack("chat_message", conversation_id, node_map[node_id], payload),
+                            delivery_mode=DeliveryMode.PERSISTENT
+                        ),
+                        routing_key=node_id,
+                        timeout=PUBLISH_CONFIRM_TIMEOUT,
+                    )
+                    for node_id in node_ids
                 ),
-                routing_key=node_id,
+                return_exceptions=True,
             )
-        logging.debug(f"[distribute_message] Published message to {len(node_map)} node(s).")
-
     except Exception as e:
         logging.error("[distribute_message] Error publishing message: %s", e)
-        raise HTTPException(
-            status_code=500, detail=f"Error distributing message: {e}"
-        )
+        outcome["failed"] = {node_id: str(e) for node_id in node_ids}
+        return outcome
+
+    for node_id, result in zip(node_ids, results):
+        if isinstance(result, BaseException):
+            logging.error("[distribute_message] Publish to %s not confirmed: %s", node_id, result)
+            outcome["failed"][node_id] = str(result) or type(result).__name__
+        else:
+            outcome["published"].append(node_id)
+    logging.debug(f"[distribute_message] Published message to {len(outcome['published'])}/{len(node_ids)} node(s).")
+    return outcome
@@ -0,0 +1,51 @@
+"""
+Idempotent schema changes applied at chat-service startup, in every
+environment (create_all only runs in development and never alters existing
+tables). Each step is safe to run concurrently from several nodes.
+"""
+from sqlalchemy import text
+
+# Serializes migrations across chat-service nodes
+_MIGRATION_LOCK_ID = 0x63686174
+
+
+async def add_direct_pair_keys(conn):
+    """
+    conversations.pair_key: adds the column, backfills it for existing direct
+    chats and then creates its unique index. If a pair already has several
+    direct chats, only the oldest gets the key; the others keep working but
+    are no longer returned by create_conversation.
+    """
+    await conn.execute(text("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS pair_key varchar(73)"))
+    await conn.execute(text("""
+        UPDATE conversations c
+        SET pair_key = ranked.pair_key
+        FROM (
+            SELECT
+                p.conversation_id,
+                p.pair_key,
+                row_number() OVER (PARTITION BY p.pair_key ORDER BY c2.created_at, c2.id) AS rn
+            FROM (
+                SELECT conversation_id,
+                       string_agg(user_id::text, ':' ORDER BY user_id::text) AS pair_key,
+                       count(*) AS members
+                FROM users_conversation
+                GROUP BY conversation_id
+            ) p
+            JOIN conversations c2 ON c2.id = p.conversation_id
+            WHERE c2.type = 'direct' AND p.members = 2
+        ) ranked
+        WHERE c.id = ranked.conversation_id
+          AND ranked.rn = 1
+          AND c.pair_key IS NULL
+          AND NOT EXISTS (SELECT 1 FROM conversations k WHERE k.pair_key = ranked.pair_key)
+    """))
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS conversations_pair_key_key ON conversations (pair_key)"
+    ))
+
+
+async def run_migrations(engine):
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _MIGRATION_LOCK_ID})
+        await add_direct_pair_keys(conn)
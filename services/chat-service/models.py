@@ -1,11 +1,14 @@
 import uuid
-from sqlalchemy import Column, String, DateTime, Text
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, String, DateTime, Text, Index, Computed
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR
 from sqlalchemy.sql import func
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import declarative_base, deferred
 
 Base = declarative_base()
 
+# 'simple' config: no stemming or stop words, since chat messages mix languages
+CONTENT_TSV_EXPRESSION = "to_tsvector('simple', content)"
+
 
 class Conversation(Base):
     __tablename__ = "conversations"
@@ -13,6 +16,9 @@ class Conversation(Base):
     name = Column(String(255), nullable=True)
     type = Column(String(50), nullable=False)   # "direct", "group"
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Direct chats only: "<lower user id>:<higher user id>", so each pair has
+    # at most one direct conversation (unique index; NULL for groups)
+    pair_key = Column(String(73), nullable=True, unique=True)
     # no relationship fields
 
 class UsersConversation(Base):
@@ -30,4 +36,16 @@ class Message(Base):
     user_id = Column(UUID(as_uuid=True), nullable=False)         # no ForeignKey
     content = Column(Text, nullable=False)
     type = Column(String(50), nullable=False)
-    sent_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    # Part of the primary key because messages is partitioned by month on sent_at
+    sent_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+    # Full-text search over content, maintained by Postgres on every insert
+    content_tsv = deferred(Column(TSVECTOR, Computed(CONTENT_TSV_EXPRESSION, persisted=True)))
+
+    # Keyset pagination of history: WHERE conversation_id = ? AND (sent_at, id) < (?, ?)
+    __table_args__ = (
+        Index("ix_messages_conversation_sent_at_id", "conversation_id", "sent_at", "id"),
+        Index("ix_messages_content_tsv", "content_tsv", postgresql_using="gin"),
+        # Monthly partitions messages_YYYY_MM are created by persistence-service
+        # and archived/dropped by chat-service
+        {"postgresql_partition_by": "RANGE (sent_at)"},
+    )
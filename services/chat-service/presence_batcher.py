@@ -0,0 +1,97 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# send(status, [(user_id, device_id), ...]) applies one batch remotely
+SendBatch = Callable[[str, List[Tuple[str, str]]], Awaitable[None]]
+
+
+class PresenceBatcher:
+    """
+    Coalesces device connect/disconnect events into batches.
+
+    Events are collected for up to `window` seconds (or until `max_batch`
+    devices are pending) and then handed to `send` as at most one "online" and
+    one "offline" call per `max_batch` devices. Within a window the last event
+    of a device wins, so a device that flaps is sent once with its final
+    status. Batches are sent one after another, never concurrently, so a
+    device's updates can't overtake each other.
+
+    `submit` returns a future that resolves once the batch holding the event
+    has been sent.
+    """
+
+    def __init__(self, send: SendBatch, window: float, max_batch: int):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[Tuple[str, str], str] = {}
+        self._waiters: List[asyncio.Future] = []
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.events = 0
+        self.batches = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        Stops the flush loop and sends whatever is still pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def submit(self, user_id: str, device_id: str, status: str) -> asyncio.Future:
+        self._pending[(user_id, device_id)] = status
+        self.events += 1
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        return waiter
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.window)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        self._full.clear()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        waiters, self._waiters = self._waiters, []
+
+        by_status: Dict[str, List[Tuple[str, str]]] = {}
+        for device, status in pending.items():
+            by_status.setdefault(status, []).append(device)
+        try:
+            for status, devices in by_status.items():
+                for start in range(0, len(devices), self.max_batch):
+                    chunk = devices[start:start + self.max_batch]
+                    try:
+                        await self.send(status, chunk)
+                        self.batches += 1
+                    except Exception as e:
+                        print(f"[presence_batcher] Failed to send {len(chunk)} {status} update(s): {e}")
+        finally:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "events": self.events,
+            "batches": self.batches,
+        }
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set
+
+# resolve(user_ids) -> {user_id: {device_id: node_id}} of their online devices
+ResolveDevices = Callable[[List[str]], Awaitable[Dict[str, Dict[str, str]]]]
+
+# Distinguishes "not subscribed" from a None (not yet known) status
+MISSING_STATUS = object()
+
+
+class PresenceSubscriptions:
+    """
+    Pushes contact presence to the local connections that asked for it.
+
+    A connection subscribes to a set of user_ids and gets an initial snapshot.
+    Each presence_updates event for a watched user only marks it due. Once
+    `debounce` seconds have passed, its status ("online" if any device is
+    routable) is resolved again and pushed to every watcher that hasn't seen
+    that status yet. One frame per connection carries all of its changes:
+
+        {"event_type": "presence", "updates": [{"user_id": ..., "status": ...}]}
+
+    A user is pushed at most once per `min_interval` seconds, so a flapping
+    device costs one frame per interval. A device that flaps back before its
+    push is due costs none, because the final status matches the last one sent.
+
+    Devices that go offline because their node's lease expired produce no
+    event, so every watched user is also re-checked each `recheck_interval`
+    seconds (only changed statuses are pushed).
+    """
+
+    def __init__(
+        self,
+        resolve: ResolveDevices,
+        debounce: float,
+        min_interval: float,
+        max_per_connection: int,
+        recheck_interval: float,
+    ):
+        self.resolve = resolve
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.max_per_connection = max_per_connection
+        self.recheck_interval = recheck_interval
+        # watched user_id -> connections watching it
+        self._watchers: Dict[str, Set[Hashable]] = {}
+        # connection -> {watched user_id: last status sent to it (None if none yet)}
+        self._sent: Dict[Hashable, Dict[str, Optional[str]]] = {}
+        # user_id -> monotonic time its pending change may be pushed
+        self._due: Dict[str, float] = {}
+        # user_id -> monotonic time of its last push
+        self._last_push: Dict[str, float] = {}
+        # connection -> its snapshots still being resolved
+        self._snapshots: Dict[Hashable, Set[asyncio.Task]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._recheck_task: Optional[asyncio.Task] = None
+
+        self.events = 0
+        self.frames = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        self._recheck_task = asyncio.create_task(self._recheck())
+
+    async def close(self):
+        for task in (self._task, self._recheck_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._recheck_task = None
+
+    def subscribe(self, connection, user_ids: Iterable[str]):
+        """
+        Adds `user_ids` to what `connection` watches and starts a task that
+        sends it a snapshot of their current status, so the caller isn't held
+        up by the lookup. Raises ValueError past max_per_connection.
+        """
+        sent = self._sent.setdefault(connection, {})
+        new = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in sent]
+        if len(sent) + len(new) > self.max_per_connection:
+            if not sent:
+                del self._sent[connection]
+            raise ValueError(f"At most {self.max_per_connection} presence subscriptions per connection")
+        if not new:
+            return
+        for user_id in new:
+            sent[user_id] = None
+            self._watchers.setdefault(user_id, set()).add(connection)
+
+        tasks = self._snapshots.setdefault(connection, set())
+        task = asyncio.create_task(self._snapshot(connection, new))
+        tasks.add(task)
+
+        def done(_):
+            tasks.discard(task)
+            if not tasks and self._snapshots.get(connection) is tasks:
+                del self._snapshots[connection]
+
+        task.add_done_callback(done)
+
+    async def _snapshot(self, connection, new: List[str]):
+        try:
+            statuses = await self._statuses(new)
+        except Exception as e:
+            # Pushed by the notifier once presence can be resolved again
+            print(f"[presence_subscriptions] Snapshot failed, retrying later: {e}")
+            self._schedule(new, time.monotonic() + self.min_interval)
+            return
+        # Whatever is still subscribed once the lookup is back
+        sent = self._sent.get(connection, {})
+        updates = []
+        for user_id, status in statuses.items():
+            if user_id in sent and sent[user_id] is None:
+                sent[user_id] = status
+                updates.append({"user_id": user_id, "status": status})
+        if updates:
+            connection.send(json.dumps({"event_type": "presence", "updates": updates, "snapshot": True}))
+            self.frames += 1
+
+    def unsubscribe(self, connection, user_ids: Optional[Iterable[str]] = None):
+        """
+        Stops pushing `user_ids` (all of them if None) to `connection`.
+        """
+        if user_ids is None:
+            for task in self._snapshots.pop(connection, ()):
+                task.cancel()
+        sent = self._sent.get(connection)
+        if sent is None:
+            return
+        for user_id in list(sent if user_ids is None else user_ids):
+            if sent.pop(user_id, MISSING_STATUS) is MISSING_STATUS:
+                continue
+            watchers = self._watchers.get(user_id)
+            watchers.discard(connection)
+            if not watchers:
+                del self._watchers[user_id]
+                self._due.pop(user_id, None)
+                self._last_push.pop(user_id, None)
+        if not sent:
+            del self._sent[connection]
+
+    def on_presence_update(self, data: str):
+        """
+        presence_updates handler, data is "<user_id>:<device_id>:<status>".
+        """
+        user_id = data.split(":", 1)[0]
+        if user_id not in self._watchers:
+            return
+        self.events += 1
+        self._schedule([user_id], time.monotonic() + self.debounce)
+
+    def mark_all_due(self):
+        """
+        Re-checks every watched user, for when presence_updates events may have
+        been missed (the pub/sub subscription was re-established) or never
+        sent (a node lease expired).
+        """
+        self._schedule(list(self._watchers), time.monotonic() + self.debounce)
+
+    async def _recheck(self):
+        while True:
+            await asyncio.sleep(self.recheck_interval)
+            self.mark_all_due()
+
+    def _schedule(self, user_ids: List[str], not_before: float):
+        for user_id in user_ids:
+            if user_id in self._due or user_id not in self._watchers:
+                # Already pending: this change is coalesced into that push
+                continue
+            self._due[user_id] = max(not_before, self._last_push.get(user_id, 0.0) + self.min_interval)
+        self._wakeup.set()
+
+    async def _statuses(self, user_ids: List[str]) -> Dict[str, str]:
+        device_maps = await self.resolve(user_ids)
+        return {user_id: "online" if device_maps.get(user_id) else "offline" for user_id in user_ids}
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._due:
+                await self._wakeup.wait()
+                continue
+            delay = min(self._due.values()) - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = time.monotonic()
+            due = [user_id for user_id, at in self._due.items() if at <= now]
+            for user_id in due:
+                del self._due[user_id]
+            try:
+                await self._push(due)
+            except Exception as e:
+                print(f"[presence_subscriptions] Failed to resolve {len(due)} user(s), retrying later: {e}")
+                self._schedule(due, time.monotonic() + self.min_interval)
+
+    async def _push(self, user_ids: List[str]):
+        statuses = await self._statuses(user_ids)
+        now = time.monotonic()
+        frames: Dict[Hashable, list] = {}
+        for user_id, status in statuses.items():
+            for connection in self._watchers.get(user_id, ()):
+                sent = self._sent[connection]
+                if sent.get(user_id) != status:
+                    sent[user_id] = status
+                    frames.setdefault(connection, []).append({"user_id": user_id, "status": status})
+                    self._last_push[user_id] = now
+        for connection, updates in frames.items():
+            connection.send(json.dumps({"event_type": "presence", "updates": updates}))
+            self.frames += 1
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self._sent),
+            "watched_users": len(self._watchers),
+            "pending": len(self._due),
+            "snapshots": sum(len(tasks) for tasks in self._snapshots.values()),
+            "events": self.events,
+            "frames": self.frames,
+        }
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List
+
+from dependencies import redis_pool
+
+# channel -> callbacks invoked with the raw message data
+_handlers: Dict[str, List[Callable[[str], None]]] = {}
+# callbacks invoked whenever the subscription is (re)established, since any
+# message published while we were disconnected has been lost
+_reset_handlers: List[Callable[[], None]] = []
+
+
+def subscribe(channel: str, handler: Callable[[str], None], on_reset: Callable[[], None] = None):
+    """
+    Registers `handler` for messages on `channel`. Must be called before
+    `redis_events_loop` starts.
+    """
+    _handlers.setdefault(channel, []).append(handler)
+    if on_reset:
+        _reset_handlers.append(on_reset)
+
+
+async def redis_events_loop():
+    """
+    Background task that listens on every subscribed Redis pub/sub channel and
+    dispatches messages to their handlers. Reconnects with backoff.
+    """
+    retry_delay = 1
+    while True:
+        pubsub = redis_pool.pubsub()
+        try:
+            await pubsub.subscribe(*_handlers)
+            logging.info("[redis-events] Subscribed to %s", list(_handlers))
+            for reset in _reset_handlers:
+                reset()
+            retry_delay = 1
+
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                for handler in _handlers.get(message["channel"], []):
+                    try:
+                        handler(message["data"])
+                    except Exception as e:
+                        logging.error("[redis-events] Handler error on %s: %s", message["channel"], e)
+        except asyncio.CancelledError:
+            logging.info("[redis-events] Listener cancelled.")
+            break
+        except Exception as e:
+            logging.error("[redis-events] Subscription lost: %s. Retrying in %s seconds...", e, retry_delay)
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
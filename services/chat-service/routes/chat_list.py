@@ -0,0 +1,192 @@
+import base64
+import json
+import uuid
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from redis.exceptions import RedisError
+from sqlalchemy import select, true
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import PREVIEW_LENGTH, CHAT_LIST_BUILT_TTL
+from dependencies import get_db, redis_pool
+from models import Message, UsersConversation
+
+router = APIRouter()
+
+# user:{user_id}:conversations  zset, conversation_id scored by last activity
+#                               (latest message, or when the user joined)
+# conversation:{cid}:preview    hash of the latest message: id, sender_id,
+#                               type, content (truncated), sent_at
+# Both are kept up to date by persistence-service as messages are stored;
+# membership changes in routes/conversations.py add and remove list entries.
+# user:{user_id}:conversations:built is set once the list has been rebuilt
+# from Postgres. Those updates recreate a lost list with only the entries
+# they touch, so the list existing doesn't mean it is complete.
+
+# Up to ARGV[3] entries ordered after the cursor (ARGV[1] score, ARGV[2]
+# conversation_id) in ZREVRANGE order, as a flat member, score list.
+# KEYS: chat list
+LIST_PAGE_LUA = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[2])
+if score and tonumber(score) == tonumber(ARGV[1]) then
+    local rank = redis.call('ZREVRANK', KEYS[1], ARGV[2])
+    return redis.call('ZREVRANGE', KEYS[1], rank + 1, rank + tonumber(ARGV[3]), 'WITHSCORES')
+end
+-- The cursor entry moved or left: the rest of its score's ties (which come
+-- in reverse member order), then lower scores
+local page = {}
+local ties = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1], 'WITHSCORES')
+for i = 1, #ties, 2 do
+    if ties[i] < ARGV[2] and #page < 2 * tonumber(ARGV[3]) then
+        page[#page + 1] = ties[i]
+        page[#page + 1] = ties[i + 1]
+    end
+end
+local left = tonumber(ARGV[3]) - #page / 2
+if left > 0 then
+    local lower = redis.call('ZREVRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '-inf', 'WITHSCORES', 'LIMIT', 0, left)
+    for i = 1, #lower do
+        page[#page + 1] = lower[i]
+    end
+end
+return page
+"""
+list_page_script = redis_pool.register_script(LIST_PAGE_LUA)
+
+
+def chat_list_key(user_id: str) -> str:
+    return f"user:{user_id}:conversations"
+
+
+def built_key(user_id: str) -> str:
+    return f"{chat_list_key(user_id)}:built"
+
+
+def preview_key(conversation_id: str) -> str:
+    return f"conversation:{conversation_id}:preview"
+
+
+def encode_list_cursor(score: float, conversation_id: str) -> str:
+    raw = json.dumps([score, conversation_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_list_cursor(cursor: str):
+    try:
+        score, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(score), str(conversation_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+
+async def rebuild_chat_list(user_id: str, db: AsyncSession):
+    """
+    Recreates a user's chat list (and any missing previews) from Postgres,
+    e.g. after Redis lost it: one query for every conversation of the user
+    with its latest message.
+    """
+    latest = (
+        select(Message.id, Message.user_id, Message.type, Message.content, Message.sent_at)
+        .where(Message.conversation_id == UsersConversation.conversation_id)
+        .order_by(Message.sent_at.desc(), Message.id.desc())
+        .limit(1)
+        .lateral()
+    )
+    stmt = (
+        select(UsersConversation.conversation_id, UsersConversation.joined_at, latest)
+        .outerjoin(latest, true())
+        .where(UsersConversation.user_id == uuid.UUID(user_id))
+    )
+    rows = (await db.execute(stmt)).all()
+
+    scores = {}
+    previews = {}
+    for row in rows:
+        conversation_id = str(row.conversation_id)
+        if row.id is not None:
+            scores[conversation_id] = row.sent_at.timestamp()
+            previews[conversation_id] = {
+                "id": str(row.id),
+                "sender_id": str(row.user_id),
+                "type": row.type,
+                "content": (row.content or "")[:PREVIEW_LENGTH],
+                "sent_at": row.sent_at.timestamp(),
+            }
+        else:
+            scores[conversation_id] = row.joined_at.timestamp() if row.joined_at else 0
+
+    async with redis_pool.pipeline(transaction=False) as pipe:
+        for conversation_id in previews:
+            pipe.exists(preview_key(conversation_id))
+        exists = await pipe.execute()
+    async with redis_pool.pipeline(transaction=False) as pipe:
+        # GT: never move back an entry that persistence-service updated meanwhile
+        if scores:
+            pipe.zadd(chat_list_key(user_id), scores, gt=True)
+        for (conversation_id, preview), found in zip(previews.items(), exists):
+            if not found:
+                pipe.hset(preview_key(conversation_id), mapping=preview)
+        pipe.set(built_key(user_id), 1, ex=CHAT_LIST_BUILT_TTL)
+        await pipe.execute()
+
+
+@router.get("/users/{user_id}/conversations")
+async def get_chat_list(
+    user_id: uuid.UUID,
+    response: Response,
+    size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from the X-Next-Cursor header"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    The user's conversations, most recently active first, each with its
+    last-message preview and unread count. Pages by (last activity,
+    conversation_id) cursor; a page is one ZREVRANGEBYSCORE (O(log n + size))
+    plus one pipelined read of the page's previews and unread counts.
+    The first page rebuilds the list from Postgres unless it has been built.
+    """
+    user_id = str(user_id)
+    key = chat_list_key(user_id)
+    if cursor:
+        max_score, after_id = decode_list_cursor(cursor)
+
+    try:
+        if cursor:
+            flat = await list_page_script(keys=[key], args=[repr(max_score), after_id, size + 1])
+            entries = [(flat[i], float(flat[i + 1])) for i in range(0, len(flat), 2)]
+        else:
+            if not await redis_pool.exists(built_key(user_id)):
+                await rebuild_chat_list(user_id, db)
+            entries = await redis_pool.zrevrange(key, 0, size, withscores=True)
+    except (RedisError, SQLAlchemyError) as e:
+        print(f"[get_chat_list] Chat list lookup failed: {e}")
+        raise HTTPException(status_code=503, detail="Chat list unavailable")
+
+    has_more = len(entries) > size
+    entries = entries[:size]
+
+    async with redis_pool.pipeline(transaction=False) as pipe:
+        for conversation_id, _ in entries:
+            pipe.hgetall(preview_key(conversation_id))
+        if entries:
+            pipe.hmget(f"unread:{user_id}", [cid for cid, _ in entries])
+        results = await pipe.execute()
+    previews, unread = (results[:-1], results[-1]) if entries else ([], [])
+
+    conversations = []
+    for (conversation_id, score), preview, count in zip(entries, previews, unread):
+        if preview:
+            preview["sent_at"] = float(preview["sent_at"])
+        conversations.append({
+            "conversation_id": conversation_id,
+            "last_activity": score,
+            "preview": preview or None,
+            "unread": int(count or 0),
+        })
+
+    if has_more and entries:
+        last_id, last_score = entries[-1]
+        response.headers["X-Next-Cursor"] = encode_list_cursor(last_score, last_id)
+    return conversations
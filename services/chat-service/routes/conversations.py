@@ -1,9 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import func, select, delete
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 import uuid
 
-from dependencies import get_db
+from dependencies import get_db, publish_conversation_update, update_chat_lists
 from models import Conversation, UsersConversation
 from schemas.conversations import (
     ConversationCreate,
@@ -21,28 +22,26 @@ async def create_conversation(
     if payload.type not in ["direct", "group", "channel"]:
         raise HTTPException(status_code=400, detail="Invalid conversation type")
 
+    pair_key = None
     if payload.type == "direct":
         if len(payload.user_ids) != 2:
             raise HTTPException(status_code=400, detail="Direct chat requires exactly 2 users")
-
-        stmt = (
-            select(Conversation)
-            .join(UsersConversation, Conversation.id == UsersConversation.conversation_id)
-            .where(
-                UsersConversation.user_id.in_(payload.user_ids),
-                Conversation.type == "direct"
-            )
-            .group_by(Conversation.id)
-            .having(func.count(UsersConversation.user_id) == 2)
-        )
-        result = await db.execute(stmt)
-        existing_convo = result.scalars().first()
-        if existing_convo:
-            return existing_convo
-
-    convo = Conversation(name=payload.name, type=payload.type)
-    db.add(convo)
-    await db.flush()  # Get convo.id
+        pair_key = direct_pair_key(payload.user_ids)
+
+    # For direct chats this is an upsert on the unique pair_key: if the pair
+    # already has a conversation (even one being created concurrently), nothing
+    # is inserted and the existing one is returned
+    stmt = (
+        insert(Conversation)
+        .values(id=uuid.uuid4(), name=payload.name, type=payload.type, pair_key=pair_key)
+        .on_conflict_do_nothing(index_elements=[Conversation.pair_key])
+        .returning(Conversation)
+    )
+    convo = await db.scalar(stmt)
+    if convo is None:
+        existing_convo = await db.scalar(select(Conversation).where(Conversation.pair_key == pair_key))
+        await db.commit()
+        return existing_convo
 
     memberships = [
         UsersConversation(user_id=user_id, conversation_id=convo.id, role_in_convo="member")
@@ -52,9 +51,22 @@ async def create_conversation(
 
     await db.commit()
     await db.refresh(convo)
+    await publish_conversation_update(convo.id)
+    await update_chat_lists(
+        convo.id,
+        added=payload.user_ids,
+        score=convo.created_at.timestamp() if convo.created_at else None,
+    )
     return convo
 
 
+def direct_pair_key(user_ids) -> str:
+    """
+    Canonical key of a direct chat: both user ids, sorted, joined by ':'.
+    """
+    return ":".join(sorted(str(user_id) for user_id in user_ids))
+
+
 @router.post("/conversations/{conversation_id}/members")
 async def update_conversation_members(
     conversation_id: uuid.UUID,
@@ -65,6 +77,7 @@ async def update_conversation_members(
     if not convo:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
+    new_users = []
     if payload.action == "add":
         stmt = select(UsersConversation.user_id).where(UsersConversation.conversation_id == conversation_id)
         result = await db.execute(stmt)
@@ -89,6 +102,11 @@ async def update_conversation_members(
         raise HTTPException(status_code=400, detail="Invalid action (use 'add' or 'remove')")
 
     await db.commit()
+    await publish_conversation_update(conversation_id)
+    if payload.action == "add":
+        await update_chat_lists(conversation_id, added=new_users)
+    else:
+        await update_chat_lists(conversation_id, removed=payload.user_ids)
     return {"status": "updated"}
 
 
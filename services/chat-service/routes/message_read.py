@@ -1,43 +1,78 @@
-from fastapi import APIRouter, Depends, Query
-from sqlalchemy import select
+from fastapi import APIRouter, Depends, Query, Response, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_, func, cast, Float
 from sqlalchemy.ext.asyncio import AsyncSession
+import base64
+import json
 import uuid
+from datetime import datetime
 
 from typing import List, Optional
-from dependencies import get_db, sync_messages
+from config import SYNC_STREAM_CHUNK_SIZE
+from dependencies import get_db, sync_conversations, read_inbox, get_inbox_head
 from routes.conversations import  get_user_conversations
 from models import Message
+from archive import iter_archived_messages
 
 router = APIRouter()
 
 
+def encode_cursor(m: dict) -> str:
+    raw = json.dumps([m["sent_at"], m["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    """
+    Returns (sent_at, id) of the last message the client has seen.
+    """
+    try:
+        sent_at, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(sent_at), uuid.UUID(message_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+
 @router.get("/conversations/{conversation_id}/messages")
 async def get_paginated_messages(
     conversation_id: uuid.UUID,
+    response: Response,
     page: int = Query(1, ge=1),
     size: int = Query(50, le=100),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from the X-Next-Cursor header"),
     db: AsyncSession = Depends(get_db),
 ):
     """
     Get paginated messages for a conversation.
-    Page numbers start from 1. Each page returns 'size' messages.
     Most recent messages come first.
-    """
-    offset = (page - 1) * size
 
+    Pages by keyset: pass the X-Next-Cursor header of the previous response as
+    `cursor` to get the next (older) page. Every page is an index range scan on
+    (conversation_id, sent_at, id), so page N costs the same as page 1.
+    The header is absent on the last page. Once Postgres runs out, pages
+    continue into the cold archive (archive.py).
+
+    `page` (starting from 1, 'size' messages each) still works without a
+    cursor but is OFFSET-based, so it gets slower the deeper it goes, and it
+    does not reach archived months.
+    """
     stmt = (
         select(Message)
         .where(Message.conversation_id == conversation_id)
-        .order_by(Message.sent_at.desc())
-        .offset(offset)
+        .order_by(Message.sent_at.desc(), Message.id.desc())
         .limit(size)
     )
+    before = None
+    if cursor:
+        sent_at, message_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(Message.sent_at, Message.id) < tuple_(sent_at, message_id))
+        before = (sent_at, str(message_id))
+    elif page > 1:
+        stmt = stmt.offset((page - 1) * size)
 
     result = await db.execute(stmt)
-    messages = result.scalars().all()
-
     # Optional: Format messages for return
-    return [
+    messages = [
         {
             "id": str(m.id),
             "conversation_id": str(m.conversation_id),
@@ -46,33 +81,154 @@ async def get_paginated_messages(
             "type": m.type,
             "sent_at": m.sent_at.isoformat(),
         }
-        for m in messages
+        for m in result.scalars().all()
     ]
 
+    if len(messages) < size and (cursor or page == 1):
+        if messages:
+            before = (datetime.fromisoformat(messages[-1]["sent_at"]), messages[-1]["id"])
+        async for m in iter_archived_messages(str(conversation_id), before=before, descending=True):
+            messages.append(m)
+            if len(messages) == size:
+                break
+
+    if len(messages) == size:
+        response.headers["X-Next-Cursor"] = encode_cursor(messages[-1])
+
+    return messages
+
+
+def encode_search_cursor(m: dict) -> str:
+    raw = json.dumps([m["rank"], m["sent_at"], m["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_search_cursor(cursor: str):
+    """
+    Returns (rank, sent_at, id) of the last result the client has seen.
+    """
+    try:
+        rank, sent_at, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(rank), datetime.fromisoformat(sent_at), uuid.UUID(message_id)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {e}")
+
+
+@router.get("/conversations/{conversation_id}/search")
+async def search_messages(
+    conversation_id: uuid.UUID,
+    response: Response,
+    q: str = Query(..., min_length=1, description="Search terms (web search syntax: quotes, OR, -word)"),
+    size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from the X-Next-Cursor header"),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Full-text search of a conversation's messages, best match first (then
+    newest first). Backed by the GIN index on messages.content_tsv; pages by
+    keyset on (rank, sent_at, id) like the history endpoint. Archived months
+    are not searched.
+    """
+    query = func.websearch_to_tsquery("simple", q)
+    rank = cast(func.ts_rank(Message.content_tsv, query), Float).label("rank")
+    stmt = (
+        select(Message, rank)
+        .where(Message.conversation_id == conversation_id)
+        .where(Message.content_tsv.op("@@")(query))
+        .order_by(rank.desc(), Message.sent_at.desc(), Message.id.desc())
+        .limit(size)
+    )
+    if cursor:
+        last_rank, sent_at, message_id = decode_search_cursor(cursor)
+        stmt = stmt.where(tuple_(rank, Message.sent_at, Message.id) < tuple_(last_rank, sent_at, message_id))
+
+    result = await db.execute(stmt)
+    messages = [
+        {
+            "id": str(m.id),
+            "conversation_id": str(m.conversation_id),
+            "user_id": str(m.user_id),
+            "content": m.content,
+            "type": m.type,
+            "sent_at": m.sent_at.isoformat(),
+            "rank": r,
+        }
+        for m, r in result.all()
+    ]
+
+    if len(messages) == size:
+        response.headers["X-Next-Cursor"] = encode_search_cursor(messages[-1])
+
+    return messages
+
 
 @router.get("/sync")
 async def sync_user_messages(
     user_id: str,
     since: float = Query(..., description="Last seen timestamp (Unix)"),
     conversations: Optional[List[str]] = Query(None),
+    since_id: Optional[str] = Query(None, description="inbox_id returned by the previous sync"),
+    stream: bool = Query(False, description="Respond with one NDJSON line per conversation"),
     db: AsyncSession = Depends(get_db)
 ):
     """
     Sync unread messages for user.
-    Checks Redis first, then Postgres if needed.
-    """
-    synced = []
+    Checks Redis first, then Postgres if needed, for all conversations at once.
 
-    conv_ids = conversations or await get_user_conversations(user_id, db)
-    for cid in conv_ids:
+    With since_id, only the conversations that have entries in the user's
+    inbox stream after since_id are visited, so the cost follows the number of
+    new messages rather than the number of memberships. If the inbox was trimmed
+    past since_id, was lost and recreated since, or can't be read, this falls
+    back to syncing every conversation.
+    The response carries the inbox_id to send as since_id next time.
+
+    With stream=true the response is NDJSON instead: one
+    {"conversation_id", "messages"} line per conversation, written as soon as
+    its chunk of SYNC_STREAM_CHUNK_SIZE conversations has been synced, so only
+    one chunk is ever held in memory. The inbox_id is in the X-Inbox-Id header.
+    """
+    inbox = None
+    if since_id is not None:
         try:
-            messages = await sync_messages(cid, user_id, since)
-            synced.append({
-                "conversation_id": cid,
-                "messages": messages
-            })
-        except Exception as e:
-            print(f"[sync_user_messages] Error syncing {cid}: {e}")
-            continue
-
-    return {"synced": synced}
\ No newline at end of file
+            inbox = await read_inbox(user_id, since_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid since_id: {since_id}")
+
+    if inbox is not None:
+        changed, inbox_id = inbox
+        conv_ids = [cid for cid in changed if not conversations or cid in conversations]
+    else:
+        # Taken before reading messages, so nothing newer than it is missed
+        inbox_id = await get_inbox_head(user_id)
+        conv_ids = conversations or await get_user_conversations(user_id, db)
+
+    if stream:
+        headers = {"X-Inbox-Id": inbox_id} if inbox_id is not None else None
+        return StreamingResponse(
+            stream_synced_lines(conv_ids, since),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+
+    messages_by_conversation = await sync_conversations(conv_ids, since)
+
+    synced = [
+        {
+            "conversation_id": cid,
+            "messages": messages_by_conversation[cid]
+        }
+        for cid in conv_ids
+        if cid in messages_by_conversation
+    ]
+    return {"synced": synced, "inbox_id": inbox_id}
+
+
+async def stream_synced_lines(conv_ids: List[str], since: float):
+    for start in range(0, len(conv_ids), SYNC_STREAM_CHUNK_SIZE):
+        chunk = conv_ids[start:start + SYNC_STREAM_CHUNK_SIZE]
+        messages_by_conversation = await sync_conversations(chunk, since)
+        for cid in chunk:
+            if cid not in messages_by_conversation:
+                continue
+            line = {"conversation_id": cid, "messages": messages_by_conversation.pop(cid)}
+            yield json.dumps(line) + "\n"
@@ -0,0 +1,52 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from dependencies import redis_pool
+
+router = APIRouter()
+
+# unread:{user_id} is a hash of conversation_id -> number of messages stored
+# since the user last posted a read marker. persistence-service increments it;
+# posting a read marker removes the conversation's field.
+
+
+def unread_key(user_id: str) -> str:
+    return f"unread:{user_id}"
+
+
+@router.post("/conversations/{conversation_id}/read")
+async def mark_conversation_read(conversation_id: str, user_id: str):
+    """
+    Read marker: the user has seen everything in the conversation.
+    """
+    try:
+        await redis_pool.hdel(unread_key(user_id), conversation_id)
+    except Exception as e:
+        print(f"[mark_conversation_read] Redis error: {e}")
+        raise HTTPException(status_code=503, detail="Unread counters unavailable")
+    return {"conversation_id": conversation_id, "unread": 0}
+
+
+@router.get("/users/{user_id}/unread")
+async def get_unread_counts(
+    user_id: str,
+    conversations: Optional[List[str]] = Query(None),
+):
+    """
+    All of the user's unread counts (or only the given conversations') in one
+    Redis read, without touching any messages. Conversations with nothing
+    unread are omitted.
+    """
+    try:
+        if conversations:
+            values = await redis_pool.hmget(unread_key(user_id), conversations)
+            counts = dict(zip(conversations, values))
+        else:
+            counts = await redis_pool.hgetall(unread_key(user_id))
+    except Exception as e:
+        print(f"[get_unread_counts] Redis error: {e}")
+        raise HTTPException(status_code=503, detail="Unread counters unavailable")
+
+    unread = {cid: int(n) for cid, n in counts.items() if n and int(n) > 0}
+    return {"user_id": user_id, "unread": unread, "total": sum(unread.values())}
@@ -1,40 +1,55 @@
 import json
+import uuid
+import asyncio
 from typing import Dict
 from datetime import datetime, timezone
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from fastapi.websockets import WebSocketState
+from connections import ClientConnection
+from config import INGEST_QUEUE_SIZE, INGEST_DRAIN_TIMEOUT, SENT_AT_MAX_AGE, SENT_AT_MAX_SKEW
 from message_transport.producer import distribute_message
-from dependencies import update_presence_status
+from dependencies import update_presence_status, presence_subscriptions
 from message_transport.persistor import send_to_persistence_queue
+from message_transport.envelope import encode_payload
 
 router = APIRouter()
 
-# user_id -> {device_id -> WebSocket}
-connected_users: Dict[str, Dict[str, WebSocket]] = {}
+# user_id -> {device_id -> ClientConnection}
+connected_users: Dict[str, Dict[str, ClientConnection]] = {}
 
 @router.websocket("/ws/{user_id}/{device_id}")
 async def ws_client_server(websocket: WebSocket, user_id: str, device_id: str):
     """
     Main chat-service WebSocket endpoint that connects a client with this server node.
 
-    - On each incoming message from the client, we parse JSON and:
-      1) Persist it (enqueue to persistence).
-      2) Distribute it to the appropriate recipients (1-on-1, group, or self).
+    - Incoming frames are parsed and validated by the reader loop, then queued
+      (bounded by INGEST_QUEUE_SIZE) for this connection's processor task, which:
+      1) Persists it (enqueue to persistence, confirmed by the broker) and
+      2) Distributes it to the appropriate recipients (1-on-1, group, or self),
+      concurrently, then acks the client with the server-assigned message id.
+      While the queue is full the reader stops reading, which pushes back on the client.
     - The background consumer on each node receives the Node Messages from RabbitMQ
       and delivers them to local websockets.
+    - {"event_type": "presence_subscribe" | "presence_unsubscribe", "user_ids": [...]}
+      frames manage which contacts' presence is pushed to this connection
+      (see presence_subscriptions.py) instead of polling GET /presence/{user_id}.
     """
     await websocket.accept()
+    connection = ClientConnection(websocket, user_id, device_id)
+    connection.start()
 
     if user_id not in connected_users:
         connected_users[user_id] = {}
-    connected_users[user_id][device_id] = websocket
+    connected_users[user_id][device_id] = connection
     print(f"[chat-service] User {user_id} connected from device {device_id}.")
 
     # Update presence info
     await update_presence_status(user_id, "online", device_id=device_id)
 
+    ingest_queue: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    processor = asyncio.create_task(process_ingest_queue(ingest_queue, connection, device_id))
+
     try:
-        while True:
+        while not connection.closed:
             # Read text from gateway => user is sending a chat message
             message_text = await websocket.receive_text()
             print(f"[chat-service] Received from user {user_id}: {message_text}")
@@ -42,33 +57,44 @@ async def ws_client_server(websocket: WebSocket, user_id: str, device_id: str):
             try:
                 message_dict = json.loads(message_text)
             except json.JSONDecodeError:
-                await websocket.send_text("Invalid JSON format.")
+                connection.send("Invalid JSON format.")
+                continue
+
+            if not isinstance(message_dict, dict):
+                connection.send("Missing conversation_id.")
+                continue
+
+            if message_dict.get("event_type") in PRESENCE_FRAMES:
+                handle_presence_frame(message_dict, connection)
                 continue
 
             # Ensure required fields. The server always trusts its own user_id
             if "conversation_id" not in message_dict:
-                await websocket.send_text("Missing conversation_id.")
+                connection.send("Missing conversation_id.")
                 continue
             message_dict["sender_id"] = user_id
 
-            # Default type and sent_at if not provided
+            # Default type if not provided; sent_at outside the accepted window becomes server time
             if "type" not in message_dict:
                 message_dict["type"] = "text"
-            if "sent_at" not in message_dict:
-                message_dict["sent_at"] = datetime.now(timezone.utc).timestamp()
-
-            # Enqueue for database persistence
-            await send_to_persistence_queue(message_dict)
+            message_dict["sent_at"] = checked_sent_at(message_dict.get("sent_at"))
 
-            # The device that actually sent the message
-            message_dict["origin_device_id"] = device_id
-
-            # Unified distribution logic
-            await distribute_message(message_dict)
+            # Blocks while the processor is behind (backpressure)
+            await ingest_queue.put(message_dict)
 
     except WebSocketDisconnect:
         print(f"[chat-service] User {user_id} on device {device_id} disconnected.")
     finally:
+        # Let messages the client already sent finish processing, then stop the processor
+        try:
+            await asyncio.wait_for(ingest_queue.put(None), timeout=INGEST_DRAIN_TIMEOUT)
+            await asyncio.wait_for(processor, timeout=INGEST_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            processor.cancel()
+            print(f"[chat-service] Dropped {ingest_queue.qsize()} unprocessed message(s) from {user_id}/{device_id}")
+
+        presence_subscriptions.unsubscribe(connection)
+
         # Remove from connected list
         connected_users[user_id].pop(device_id, None)
         if not connected_users[user_id]:
@@ -76,6 +102,89 @@ async def ws_client_server(websocket: WebSocket, user_id: str, device_id: str):
         # Mark user/device offline
         await update_presence_status(user_id, "offline", device_id=device_id)
 
-        if websocket.client_state != WebSocketState.DISCONNECTED:
-            await websocket.close()
+        await connection.close()
         print(f"[chat-service] WebSocket closed for {user_id}/{device_id}")
+
+
+def checked_sent_at(sent_at) -> float:
+    """
+    The client's sent_at if it is a timestamp close to the server clock,
+    otherwise the server time.
+    """
+    now = datetime.now(timezone.utc).timestamp()
+    if isinstance(sent_at, bool) or not isinstance(sent_at, (int, float)):
+        return now
+    if not now - SENT_AT_MAX_AGE <= sent_at <= now + SENT_AT_MAX_SKEW:
+        return now
+    return float(sent_at)
+
+
+PRESENCE_FRAMES = ("presence_subscribe", "presence_unsubscribe")
+
+
+def handle_presence_frame(message_dict: dict, connection: ClientConnection):
+    user_ids = message_dict.get("user_ids")
+    if not isinstance(user_ids, list) or not all(isinstance(u, str) for u in user_ids):
+        connection.send("user_ids must be a list of user ids.")
+        return
+    if message_dict["event_type"] == "presence_unsubscribe":
+        presence_subscriptions.unsubscribe(connection, user_ids)
+        return
+    try:
+        presence_subscriptions.subscribe(connection, user_ids)
+    except ValueError as e:
+        connection.send(str(e) + ".")
+
+
+async def process_ingest_queue(ingest_queue: asyncio.Queue, connection: ClientConnection, device_id: str):
+    """
+    Handles one connection's messages in the order they were received. A None
+    item means the connection is closing.
+    """
+    while True:
+        message_dict = await ingest_queue.get()
+        if message_dict is None:
+            return
+        try:
+            await ingest_message(message_dict, connection, device_id)
+        except Exception as e:
+            print(f"[chat-service] Failed to process message from {connection.user_id}: {e}")
+
+
+async def ingest_message(message_dict: dict, connection: ClientConnection, device_id: str):
+    client_msg_id = message_dict.pop("client_msg_id", None)
+    message_dict["id"] = str(uuid.uuid4())
+
+    # The device that actually sent the message
+    message_dict["origin_device_id"] = device_id
+
+    # Encoded once: the same bytes go to persistence and, inside each node
+    # envelope, to every recipient socket
+    payload = encode_payload(message_dict)
+
+    persisted, outcome = await asyncio.gather(
+        send_to_persistence_queue(payload),
+        distribute_message(message_dict, payload),
+        return_exceptions=True,
+    )
+
+    errors = []
+    if isinstance(persisted, BaseException):
+        errors.append(f"persistence: {persisted}")
+    if isinstance(outcome, BaseException):
+        errors.append(f"distribution: {outcome}")
+    elif outcome["failed"]:
+        errors.append(f"distribution to {sorted(outcome['failed'])} failed")
+
+    ack = {
+        "event_type": "nack" if errors else "ack",
+        "message_id": message_dict["id"],
+        "conversation_id": message_dict["conversation_id"],
+        "sent_at": message_dict["sent_at"],
+    }
+    if client_msg_id is not None:
+        ack["client_msg_id"] = client_msg_id
+    if errors:
+        ack["error"] = "; ".join(errors)
+        print(f"[chat-service] Message {message_dict['id']} from {connection.user_id} not fully handled: {ack['error']}")
+    connection.send(json.dumps(ack))
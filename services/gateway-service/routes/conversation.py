@@ -2,6 +2,8 @@ from typing import Optional, List
 import uuid
 import urllib.parse
 from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import httpx
 from config import CHAT_SERVICE_URL
@@ -76,13 +78,44 @@ async def get_paginated_messages(
     conversation_id: uuid.UUID,
     page: int = 1,
     size: int = 50,
+    cursor: Optional[str] = None,
     client: httpx.AsyncClient = Depends(get_http_client)
 ):
-    url = f"http://{CHAT_SERVICE_URL}/conversations/{conversation_id}/messages?page={page}&size={size}"
+    query_params = {"page": page, "size": size}
+    if cursor:
+        query_params["cursor"] = cursor
+    url = f"http://{CHAT_SERVICE_URL}/conversations/{conversation_id}/messages?{urllib.parse.urlencode(query_params)}"
     try:
         resp = await client.get(url)
         if resp.status_code == 200:
-            return resp.json()
+            headers = {}
+            if "X-Next-Cursor" in resp.headers:
+                headers["X-Next-Cursor"] = resp.headers["X-Next-Cursor"]
+            return JSONResponse(content=resp.json(), headers=headers)
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
+
+
+@router.get("/conversations/{conversation_id}/search")
+async def search_messages(
+    conversation_id: uuid.UUID,
+    q: str,
+    size: int = 20,
+    cursor: Optional[str] = None,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    query_params = {"q": q, "size": size}
+    if cursor:
+        query_params["cursor"] = cursor
+    url = f"http://{CHAT_SERVICE_URL}/conversations/{conversation_id}/search?{urllib.parse.urlencode(query_params)}"
+    try:
+        resp = await client.get(url)
+        if resp.status_code == 200:
+            headers = {}
+            if "X-Next-Cursor" in resp.headers:
+                headers["X-Next-Cursor"] = resp.headers["X-Next-Cursor"]
+            return JSONResponse(content=resp.json(), headers=headers)
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
     except httpx.RequestError as e:
         raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
@@ -96,6 +129,8 @@ async def sync_user_messages(
     user_id: str,
     since: float,
     conversations: Optional[List[str]] = None,
+    since_id: Optional[str] = None,
+    stream: bool = False,
     client: httpx.AsyncClient = Depends(get_http_client)
 ):
     query_params = {
@@ -104,9 +139,30 @@ async def sync_user_messages(
     }
     if conversations:
         query_params["conversations"] = conversations
+    if since_id:
+        query_params["since_id"] = since_id
+    if stream:
+        query_params["stream"] = "true"
 
     url = f"http://{CHAT_SERVICE_URL}/sync?{urllib.parse.urlencode(query_params, doseq=True)}"
 
+    if stream:
+        # Relay NDJSON lines as chat-service produces them instead of buffering the body
+        try:
+            resp = await client.send(client.build_request("GET", url), stream=True)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
+        if resp.status_code != 200:
+            body = await resp.aread()
+            await resp.aclose()
+            raise HTTPException(status_code=resp.status_code, detail=body.decode("utf-8", "replace"))
+        return StreamingResponse(
+            resp.aiter_raw(),
+            media_type=resp.headers.get("content-type", "application/x-ndjson"),
+            headers={k: v for k, v in resp.headers.items() if k.lower() == "x-inbox-id"},
+            background=BackgroundTask(resp.aclose),
+        )
+
     try:
         resp = await client.get(url)
         if resp.status_code == 200:
@@ -114,3 +170,70 @@ async def sync_user_messages(
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
     except httpx.RequestError as e:
         raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
+
+
+@router.post("/conversations/{conversation_id}/read")
+@role_required("admin", "user")
+@self_user_only("user_id")
+async def mark_conversation_read(
+    request: Request,
+    conversation_id: uuid.UUID,
+    user_id: str,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    url = f"http://{CHAT_SERVICE_URL}/conversations/{conversation_id}/read?{urllib.parse.urlencode({'user_id': user_id})}"
+    try:
+        resp = await client.post(url)
+        if resp.status_code == 200:
+            return resp.json()
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
+
+
+@router.get("/users/{user_id}/unread")
+@role_required("admin", "user")
+@self_user_only("user_id")
+async def get_unread_counts(
+    request: Request,
+    user_id: str,
+    conversations: Optional[List[str]] = None,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    query_params = {}
+    if conversations:
+        query_params["conversations"] = conversations
+    url = f"http://{CHAT_SERVICE_URL}/users/{user_id}/unread?{urllib.parse.urlencode(query_params, doseq=True)}"
+    try:
+        resp = await client.get(url)
+        if resp.status_code == 200:
+            return resp.json()
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
+
+
+@router.get("/users/{user_id}/conversations")
+@role_required("admin", "user")
+@self_user_only("user_id")
+async def get_chat_list(
+    request: Request,
+    user_id: str,
+    size: int = 20,
+    cursor: Optional[str] = None,
+    client: httpx.AsyncClient = Depends(get_http_client)
+):
+    query_params = {"size": size}
+    if cursor:
+        query_params["cursor"] = cursor
+    url = f"http://{CHAT_SERVICE_URL}/users/{user_id}/conversations?{urllib.parse.urlencode(query_params)}"
+    try:
+        resp = await client.get(url)
+        if resp.status_code == 200:
+            headers = {}
+            if "X-Next-Cursor" in resp.headers:
+                headers["X-Next-Cursor"] = resp.headers["X-Next-Cursor"]
+            return JSONResponse(content=resp.json(), headers=headers)
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=500, detail=f"Chat service error: {str(e)}")
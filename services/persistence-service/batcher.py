@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aio_pika import IncomingMessage
+
+
+class MessageBatcher:
+    """
+    Collects deliveries from the persistence queue and hands them to `handler`
+    in batches of up to `max_size` messages, or whatever has accumulated after
+    `flush_interval` seconds.
+
+    Flushes run one at a time and in delivery order, so a batch can be acked with
+    a single `ack(multiple=True)` on its last delivery without touching messages
+    that belong to a later, still-pending batch.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[dict]], Awaitable[int]],
+        max_size: int,
+        flush_interval: float,
+        retry_delay: float = 1.0,
+    ):
+        self.handler = handler
+        self.max_size = max(1, max_size)
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+
+        self._pending: List[IncomingMessage] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+        self.stats: Dict[str, float] = {
+            "batches": 0,
+            "messages": 0,
+            "rows_written": 0,
+            "malformed": 0,
+            "failed_batches": 0,
+            "size_flushes": 0,
+            "timer_flushes": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+        }
+
+    async def add(self, msg: IncomingMessage):
+        """
+        aio-pika consumer callback.
+        """
+        self._pending.append(msg)
+        if len(self._pending) >= self.max_size:
+            self.stats["size_flushes"] += 1
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        self.stats["timer_flushes"] += 1
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+
+        # Take ownership of the pending deliveries before awaiting the lock, so
+        # batches queue up on the lock in the order they were cut.
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        async with self._flush_lock:
+            started = time.perf_counter()
+            records = []
+            for msg in batch:
+                try:
+                    records.append(json.loads(msg.body.decode()))
+                except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                    # Acked along with the rest of the batch, there is no point redelivering it.
+                    self.stats["malformed"] += 1
+                    print(f"[persistence-service] Dropping malformed message: {e}")
+
+            try:
+                written = await self.handler(records)
+                await batch[-1].ack(multiple=True)
+            except Exception as e:
+                self.stats["failed_batches"] += 1
+                print(f"[persistence-service] Failed storing batch of {len(batch)}, requeueing: {e}")
+                # Holding the flush lock, so later batches wait instead of hammering a failing store
+                await asyncio.sleep(self.retry_delay)
+                try:
+                    await batch[-1].nack(multiple=True, requeue=True)
+                except Exception as nack_error:
+                    print(f"[persistence-service] Failed to nack batch: {nack_error}")
+                return
+
+            self.stats["batches"] += 1
+            self.stats["messages"] += len(batch)
+            self.stats["rows_written"] += written
+            self.stats["last_batch_size"] = len(batch)
+            self.stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            logging.debug(
+                "[persistence-service] Stored batch of %s message(s) in %sms",
+                len(batch), self.stats["last_flush_ms"],
+            )
+
+
+async def report_stats(batcher: MessageBatcher, redis, interval: float):
+    """
+    Periodically logs the batch counters and mirrors them into the
+    `persistence:stats` Redis hash so they can be inspected from outside.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("[persistence-service] Batch stats: %s", batcher.stats)
+        try:
+            await redis.hset("persistence:stats", mapping=batcher.stats)
+        except Exception as e:
+            print(f"[persistence-service] Could not publish stats: {e}")
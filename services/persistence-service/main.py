@@ -2,8 +2,18 @@ import asyncio
 import logging
 from aio_pika import connect_robust, ExchangeType
 
-from persistence import on_persistence_message, init_db
-from config import RABBIT_HOST, RABBIT_PORT
+from batcher import MessageBatcher, report_stats
+from persistence import on_persistence_message, init_db, store_batch, redis, engine
+from partitions import ensure_partitions, maintain_partitions
+from config import (
+    RABBIT_HOST,
+    RABBIT_PORT,
+    BATCH_SIZE,
+    BATCH_FLUSH_INTERVAL_MS,
+    PREFETCH_COUNT,
+    STATS_INTERVAL,
+    STORE_RETRY_DELAY,
+)
 
 EXCHANGE_NAME = "persistence-exchange"
 QUEUE_NAME = "persistence-queue"
@@ -12,17 +22,27 @@ async def main():
     logging.basicConfig(level=logging.INFO)
     print("[persistence-service] Starting up...")
 
-    # Ensure DB tables are created
+    # Ensure DB tables and the monthly message partitions are created
     await init_db()
+    await ensure_partitions(engine)
+    asyncio.create_task(maintain_partitions(engine))
 
     connection = await connect_robust(host=RABBIT_HOST, port=RABBIT_PORT)
     channel = await connection.channel()
+    # A batch can only fill up if the broker lets that many deliveries be unacked at once
+    await channel.set_qos(prefetch_count=max(PREFETCH_COUNT, BATCH_SIZE))
 
     exchange = await channel.declare_exchange(EXCHANGE_NAME, ExchangeType.DIRECT, durable=True)
     queue = await channel.declare_queue(QUEUE_NAME, durable=True)
     await queue.bind(exchange, routing_key="store")
 
-    await queue.consume(on_persistence_message, no_ack=False)
+    if BATCH_SIZE > 1:
+        batcher = MessageBatcher(store_batch, BATCH_SIZE, BATCH_FLUSH_INTERVAL_MS / 1000, STORE_RETRY_DELAY)
+        asyncio.create_task(report_stats(batcher, redis, STATS_INTERVAL))
+        await queue.consume(batcher.add, no_ack=False)
+        print(f"[persistence-service] Batching up to {BATCH_SIZE} messages / {BATCH_FLUSH_INTERVAL_MS}ms")
+    else:
+        await queue.consume(on_persistence_message, no_ack=False)
 
     print(f"[persistence-service] Listening on queue: {QUEUE_NAME}")
     await asyncio.Future()  # Keeps service alive
@@ -1,11 +1,24 @@
 import uuid
-from sqlalchemy import Column, String, DateTime, Text
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, String, DateTime, Text, Index, Computed
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR
 from sqlalchemy.sql import func
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
+# 'simple' config: no stemming or stop words, since chat messages mix languages
+CONTENT_TSV_EXPRESSION = "to_tsvector('simple', content)"
+
+# Owned by chat-service; read here to find the recipients of each message
+class UsersConversation(Base):
+    __tablename__ = "users_conversation"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID(as_uuid=True), nullable=False)
+    conversation_id = Column(UUID(as_uuid=True), nullable=False)
+    role_in_convo = Column(String(255), nullable=True)
+    joined_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -14,4 +27,16 @@ class Message(Base):
     user_id = Column(UUID(as_uuid=True), nullable=False)
     content = Column(Text, nullable=False)
     type = Column(String(50), nullable=False)
-    sent_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Part of the primary key because messages is partitioned by month on sent_at
+    sent_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
+    # Full-text search over content, maintained by Postgres on every insert
+    content_tsv = Column(TSVECTOR, Computed(CONTENT_TSV_EXPRESSION, persisted=True))
+
+    # Keyset pagination of history: WHERE conversation_id = ? AND (sent_at, id) < (?, ?)
+    __table_args__ = (
+        Index("ix_messages_conversation_sent_at_id", "conversation_id", "sent_at", "id"),
+        Index("ix_messages_content_tsv", "content_tsv", postgresql_using="gin"),
+        # Monthly partitions messages_YYYY_MM are created by persistence-service
+        # and archived/dropped by chat-service
+        {"postgresql_partition_by": "RANGE (sent_at)"},
+    )
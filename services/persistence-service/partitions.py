@@ -0,0 +1,109 @@
+import asyncio
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+
+from config import PARTITION_PREMAKE_MONTHS, PARTITION_CHECK_INTERVAL
+
+# messages is range-partitioned by month on sent_at. Partitions are named
+# messages_YYYY_MM and cover [first of month, first of next month). chat-service
+# archives and drops the old ones (see chat-service/archive.py).
+PARTITIONED_TABLE = "messages"
+
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARTITIONED_TABLE}_{month.year:04d}_{month.month:02d}"
+
+
+async def is_partitioned(conn) -> bool:
+    relkind = await conn.scalar(
+        text("SELECT relkind FROM pg_class WHERE relname = :name AND relkind IN ('r', 'p')"),
+        {"name": PARTITIONED_TABLE},
+    )
+    return relkind == "p"
+
+
+# Columns moved out of the default partition (content_tsv is generated)
+MESSAGE_COLUMNS = "id, conversation_id, user_id, content, type, sent_at"
+
+
+async def create_partition(conn, month: date):
+    """
+    Creates the partition for `month`. Rows for that month already in the
+    default partition (which would make CREATE ... PARTITION OF fail) are moved
+    out first and re-inserted into the new partition, in the same transaction.
+    """
+    name = partition_name(month)
+    exists = await conn.scalar(text("SELECT 1 FROM pg_class WHERE relname = :name"), {"name": name})
+    if exists:
+        return
+    bounds = {"start": month, "end": add_months(month, 1)}
+    default = f"{PARTITIONED_TABLE}_default"
+    await conn.execute(text(
+        f"CREATE TEMP TABLE moved_messages ON COMMIT DROP AS "
+        f"SELECT {MESSAGE_COLUMNS} FROM {default} WITH NO DATA"
+    ))
+    await conn.execute(text(
+        f"WITH moved AS (DELETE FROM {default} WHERE sent_at >= :start AND sent_at < :end "
+        f"RETURNING {MESSAGE_COLUMNS}) INSERT INTO moved_messages SELECT * FROM moved"
+    ), bounds)
+    await conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {PARTITIONED_TABLE} "
+        f"FOR VALUES FROM ('{bounds['start'].isoformat()}') TO ('{bounds['end'].isoformat()}')"
+    ))
+    moved = await conn.execute(text(
+        f"INSERT INTO {PARTITIONED_TABLE} ({MESSAGE_COLUMNS}) SELECT {MESSAGE_COLUMNS} FROM moved_messages"
+    ))
+    if moved.rowcount:
+        print(f"[partitions] Moved {moved.rowcount} message(s) from {default} into {name}")
+
+
+async def ensure_partitions(engine, months_ahead=PARTITION_PREMAKE_MONTHS):
+    """
+    Creates the partitions for the current month and the next `months_ahead`
+    months, plus a default partition so an unexpected sent_at never fails an
+    insert. Idempotent.
+
+    Rows that did land in the default partition get their month's partition
+    here too, so the default only ever holds rows until the next run. It is
+    not archived itself: once moved, those rows are archived with their month
+    (chat-service/archive.py). Each month is created in its own transaction and
+    a failure is logged without stopping the others.
+    """
+    this_month = datetime.now(timezone.utc).date().replace(day=1)
+    async with engine.begin() as conn:
+        if not await is_partitioned(conn):
+            print(f"[partitions] '{PARTITIONED_TABLE}' is not a partitioned table; skipping partition management")
+            return
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {PARTITIONED_TABLE}_default PARTITION OF {PARTITIONED_TABLE} DEFAULT"
+        ))
+        stray = await conn.scalars(text(
+            f"SELECT DISTINCT date_trunc('month', sent_at AT TIME ZONE 'UTC')::date "
+            f"FROM {PARTITIONED_TABLE}_default"
+        ))
+        months = set(stray) | {add_months(this_month, n) for n in range(months_ahead + 1)}
+
+    for month in sorted(months):
+        try:
+            async with engine.begin() as conn:
+                await create_partition(conn, month)
+        except Exception as e:
+            print(f"[partitions] Failed to create {partition_name(month)}: {e}")
+
+
+async def maintain_partitions(engine, interval=PARTITION_CHECK_INTERVAL):
+    """
+    Keeps partitions created ahead of time while the service runs.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await ensure_partitions(engine)
+        except Exception as e:
+            print(f"[partitions] Partition maintenance failed: {e}")
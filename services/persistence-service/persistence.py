@@ -1,18 +1,107 @@
+import asyncio
 import json
+import math
 import uuid
 from datetime import datetime, timezone
 
 from redis.asyncio import Redis
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from aio_pika import IncomingMessage
 
-from config import REDIS_HOST, REDIS_PORT, DATABASE_URL
-from models import Message as DBMessage, Base
+from config import (
+    REDIS_HOST,
+    REDIS_PORT,
+    DATABASE_URL,
+    REDIS_MESSAGE_WINDOW,
+    REDIS_MESSAGE_WINDOW_MAX,
+    REDIS_WINDOW_HOT_SECONDS,
+    REDIS_WINDOW_RATE_INTERVAL,
+    REDIS_META_TTL,
+    INBOX_MAXLEN,
+    PREVIEW_LENGTH,
+    DEAD_LETTER_MAXLEN,
+    STORE_RETRY_DELAY,
+)
+from models import Message as DBMessage, UsersConversation, Base, CONTENT_TSV_EXPRESSION
 
 # Redis setup
 redis = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
+# Appends messages to one conversation's hot set and trims it to a window sized
+# by the conversation's write rate.
+# KEYS: chat:{cid}:messages, chat:{cid}:meta
+# ARGV: now, rate interval, min window, max window, hot seconds, meta ttl,
+#       then score, member pairs
+# chat:{cid}:meta holds the current sample (started, count), the writes/sec
+# of the last complete sample (rate) and the resulting window. chat-service
+# reads the window when it refills the set and sets "warm" once it has, plus
+# "complete" if the set then held the whole conversation (dropped on any trim).
+APPEND_MESSAGES_LUA = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local n = (#ARGV - 6) / 2
+-- One ZADD per key with all its members, in chunks (an even number of
+-- arguments, so pairs stay together) that stay under unpack's stack limit
+local chunk = 4000
+for i = 7, #ARGV, chunk do
+    redis.call('ZADD', KEYS[1], unpack(ARGV, i, math.min(i + chunk - 1, #ARGV)))
+end
+
+local meta = redis.call('HMGET', KEYS[2], 'started', 'count', 'rate')
+local started = tonumber(meta[1]) or now
+local count = tonumber(meta[2]) or 0
+local rate = tonumber(meta[3]) or 0
+if now - started >= interval then
+    rate = count / (now - started)
+    started = now
+    count = n
+else
+    count = count + n
+end
+
+local window = math.ceil(math.max(rate, count / interval) * tonumber(ARGV[5]))
+window = math.min(math.max(window, tonumber(ARGV[3])), tonumber(ARGV[4]))
+if redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(window + 1)) > 0 then
+    redis.call('HDEL', KEYS[2], 'complete')
+end
+redis.call('HSET', KEYS[2], 'started', started, 'count', count, 'rate', tostring(rate), 'window', window)
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+return window
+"""
+append_messages_script = redis.register_script(APPEND_MESSAGES_LUA)
+
+# Replaces a conversation's last-message preview unless the stored one is newer
+# (messages from different chat nodes can arrive slightly out of order).
+# KEYS: conversation:{cid}:preview  ARGV: sent_at, then field, value pairs
+SET_PREVIEW_LUA = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'sent_at'))
+if current and current >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+return 1
+"""
+set_preview_script = redis.register_script(SET_PREVIEW_LUA)
+
+# Appends an entry to a user's inbox stream. A stream created by this call
+# (or whose epoch key is gone) gets a new epoch, the id of its first entry,
+# so chat-service can tell an inbox_id issued for a lost stream from one
+# issued for the current one.
+# KEYS: inbox:{user_id}, inbox:{user_id}:epoch  ARGV: maxlen, then field, value pairs
+APPEND_INBOX_LUA = """
+local fresh = redis.call('EXISTS', KEYS[1]) == 0 or redis.call('EXISTS', KEYS[2]) == 0
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', unpack(ARGV, 2))
+if fresh then
+    redis.call('SET', KEYS[2], id)
+end
+return id
+"""
+append_inbox_script = redis.register_script(APPEND_INBOX_LUA)
+
 # Async SQLAlchemy engine + session
 engine = create_async_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
 AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
@@ -21,42 +110,279 @@ AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_com
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips new columns and indexes on tables that already exist.
+        # Adding the stored column rewrites an existing table once.
+        await conn.execute(text(
+            f"ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+            f"GENERATED ALWAYS AS ({CONTENT_TSV_EXPRESSION}) STORED"
+        ))
+        await conn.run_sync(create_missing_indexes)
 
-# Store message in Redis
-async def store_message_in_redis(msg_data):
-    cid = str(msg_data["conversation_id"])
-    message_json = json.dumps(msg_data)
+
+def create_missing_indexes(sync_conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+# Store messages in Redis
+async def store_messages_in_redis(batch, recipients_by_conversation=None):
+    """
+    Groups the batch by conversation so every hot-store key gets its new
+    members added and is trimmed to its adaptive window by one script call,
+    and sends everything in one round trip.
+
+    When recipients_by_conversation is given, the same pipeline also:
+      - appends a compact {c, m, t} entry to every recipient's inbox:{user_id} stream
+      - bumps unread:{user_id}[conversation_id] for every recipient but the sender
+      - updates conversation:{cid}:preview with the conversation's latest message
+      - raises the conversation's score (last activity) in every recipient's
+        user:{user_id}:conversations chat list
+    These writes follow the hot-store writes, so a client that sees an inbox
+    entry can always find the message itself.
+    """
+    if not batch:
+        return
+    members_by_conversation = {}
+    for msg_data in batch:
+        members = members_by_conversation.setdefault(msg_data["conversation_id"], [])
+        members.extend((msg_data["sent_at"], json.dumps(msg_data)))
+    now = datetime.now(timezone.utc).timestamp()
     try:
-        await redis.zadd(f"chat:{cid}:messages", {message_json: msg_data["sent_at"]})
-        await redis.zremrangebyrank(f"chat:{cid}:messages", 0, -101)
+        async with redis.pipeline(transaction=False) as pipe:
+            for conversation_id, members in members_by_conversation.items():
+                await append_messages_script(
+                    keys=[f"chat:{conversation_id}:messages", f"chat:{conversation_id}:meta"],
+                    args=[
+                        now,
+                        REDIS_WINDOW_RATE_INTERVAL,
+                        REDIS_MESSAGE_WINDOW,
+                        REDIS_MESSAGE_WINDOW_MAX,
+                        REDIS_WINDOW_HOT_SECONDS,
+                        REDIS_META_TTL,
+                        *members,
+                    ],
+                    client=pipe,
+                )
+            if recipients_by_conversation:
+                unread = {}
+                for msg_data in batch:
+                    conversation_id = msg_data["conversation_id"]
+                    entry = ["c", conversation_id, "m", msg_data.get("id", ""), "t", msg_data["sent_at"]]
+                    for user_id in recipients_by_conversation.get(conversation_id, ()):
+                        await append_inbox_script(
+                            keys=[f"inbox:{user_id}", f"inbox:{user_id}:epoch"],
+                            args=[INBOX_MAXLEN, *entry],
+                            client=pipe,
+                        )
+                        if user_id != msg_data["sender_id"]:
+                            unread[(user_id, conversation_id)] = unread.get((user_id, conversation_id), 0) + 1
+                # One HINCRBY per recipient and conversation in the batch
+                for (user_id, conversation_id), count in unread.items():
+                    pipe.hincrby(f"unread:{user_id}", conversation_id, count)
+
+                # Chat lists: latest message per conversation becomes its
+                # preview and its recipients' user:{uid}:conversations score
+                latest = {}
+                for msg_data in batch:
+                    current = latest.get(msg_data["conversation_id"])
+                    if current is None or msg_data["sent_at"] >= current["sent_at"]:
+                        latest[msg_data["conversation_id"]] = msg_data
+                for conversation_id, msg_data in latest.items():
+                    await set_preview_script(
+                        keys=[f"conversation:{conversation_id}:preview"],
+                        args=[msg_data["sent_at"], *preview_fields(msg_data)],
+                        client=pipe,
+                    )
+                    for user_id in recipients_by_conversation.get(conversation_id, ()):
+                        pipe.zadd(f"user:{user_id}:conversations", {conversation_id: msg_data["sent_at"]}, gt=True)
+            await pipe.execute()
     except Exception as e:
-        print(f"[store_message_in_redis] Redis error: {e}")
+        print(f"[store_messages_in_redis] Redis error: {e}")
 
-# Store message in Postgres (async)
-async def store_message_in_postgres(msg_data):
+def preview_fields(msg_data):
+    preview = {
+        "id": msg_data.get("id", ""),
+        "sender_id": msg_data["sender_id"],
+        "type": msg_data["type"],
+        "content": (msg_data.get("content") or "")[:PREVIEW_LENGTH],
+        "sent_at": msg_data["sent_at"],
+    }
+    return [item for pair in preview.items() for item in pair]
+
+async def get_recipients(batch):
+    """
+    Returns conversation_id -> set of user_ids that should get an inbox entry:
+    the conversation's members (one query for the whole batch), plus the
+    sender and toUser of each message, the same recipients distribute_message uses.
+    """
+    recipients = {}
+    for msg_data in batch:
+        users = recipients.setdefault(msg_data["conversation_id"], set())
+        users.add(msg_data["sender_id"])
+        if msg_data.get("toUser"):
+            users.add(msg_data["toUser"])
+    try:
+        conversation_ids = [uuid.UUID(cid) for cid in recipients]
+    except ValueError as e:
+        print(f"[get_recipients] Invalid conversation id in batch: {e}")
+        return recipients
     async with AsyncSessionLocal() as session:
         try:
-            dt_sent = datetime.fromtimestamp(msg_data["sent_at"], timezone.utc)
-            new_msg = DBMessage(
-                id=uuid.uuid4(),
-                conversation_id=msg_data["conversation_id"],
-                user_id=msg_data["sender_id"],
-                content=msg_data.get("content"),
-                type=msg_data["type"],
-                sent_at=dt_sent,
+            result = await session.execute(
+                select(UsersConversation.conversation_id, UsersConversation.user_id)
+                .where(UsersConversation.conversation_id.in_(conversation_ids))
             )
-            session.add(new_msg)
-            await session.commit()
+            for conversation_id, user_id in result.all():
+                recipients[str(conversation_id)].add(str(user_id))
         except Exception as e:
-            print(f"[store_message_in_postgres] DB error: {e}")
+            print(f"[get_recipients] DB error: {e}")
+    return recipients
+
+async def store_hot_and_inbox(batch):
+    await store_messages_in_redis(batch, await get_recipients(batch))
+
+async def store_message_in_redis(msg_data):
+    await store_hot_and_inbox([msg_data])
+
+def to_db_row(msg_data):
+    return {
+        # chat-service assigns the id when it accepts the message
+        "id": uuid.UUID(msg_data["id"]) if msg_data.get("id") else uuid.uuid4(),
+        "conversation_id": msg_data["conversation_id"],
+        "user_id": msg_data["sender_id"],
+        "content": msg_data.get("content"),
+        "type": msg_data["type"],
+        "sent_at": datetime.fromtimestamp(msg_data["sent_at"], timezone.utc),
+    }
+
+# Messages that can't be stored because of their own content, newest first
+DEAD_LETTER_KEY = "persistence:dead_letters"
+# Errors caused by the rows themselves. Anything else (connection lost,
+# database down) fails the whole batch so it is nacked and redelivered.
+ROW_ERRORS = (DataError, IntegrityError, KeyError, ValueError, TypeError)
+
+REQUIRED_FIELDS = ("conversation_id", "sender_id", "type", "sent_at")
+
+def check_record(msg_data):
+    """
+    Raises KeyError, TypeError or ValueError unless msg_data is a message
+    both the Redis and the Postgres writes can take.
+    """
+    if not isinstance(msg_data, dict):
+        raise TypeError(f"expected an object, got {type(msg_data).__name__}")
+    for field in REQUIRED_FIELDS:
+        if field not in msg_data:
+            raise KeyError(field)
+    for field in ("conversation_id", "sender_id"):
+        if not isinstance(msg_data[field], str):
+            raise TypeError(f"{field} must be a string")
+    sent_at = msg_data["sent_at"]
+    if isinstance(sent_at, bool) or not isinstance(sent_at, (int, float)) or not math.isfinite(sent_at):
+        raise TypeError("sent_at must be a Unix timestamp")
+    uuid.UUID(msg_data["conversation_id"])
+    to_db_row(msg_data)
 
-# Message consumer callback
+async def valid_records(batch):
+    """
+    The records of `batch` that pass check_record; the rest are dead-lettered
+    once here, so a bad record never fails (and requeues) its batch.
+    """
+    valid = []
+    for msg_data in batch:
+        try:
+            check_record(msg_data)
+        except ROW_ERRORS as e:
+            await dead_letter(msg_data, e)
+            continue
+        valid.append(msg_data)
+    return valid
+
+async def dead_letter(msg_data, error):
+    message_id = msg_data.get("id") if isinstance(msg_data, dict) else None
+    print(f"[persistence-service] Dead-lettering message {message_id}: {error}")
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(DEAD_LETTER_KEY, json.dumps({"message": msg_data, "error": str(error)}))
+            pipe.ltrim(DEAD_LETTER_KEY, 0, DEAD_LETTER_MAXLEN - 1)
+            await pipe.execute()
+    except Exception as e:
+        print(f"[persistence-service] Could not dead-letter message {message_id}: {e}")
+
+async def insert_rows(rows):
+    # Redelivered messages are already stored: skip them instead of failing
+    async with AsyncSessionLocal() as session:
+        await session.execute(insert(DBMessage).values(rows).on_conflict_do_nothing())
+        await session.commit()
+
+# Store message in Postgres (async)
+async def store_message_in_postgres(msg_data):
+    await store_messages_in_postgres([msg_data])
+
+async def store_messages_in_postgres(batch):
+    """
+    Writes the whole batch with one multi-row INSERT in a single transaction.
+    Returns the number of rows written.
+
+    If a row is rejected (bad data), the rows are retried one by one and only
+    the failing ones are dead-lettered. Any other error is raised so the
+    caller requeues the batch.
+    """
+    rows = []
+    for msg_data in batch:
+        try:
+            rows.append((msg_data, to_db_row(msg_data)))
+        except ROW_ERRORS as e:
+            await dead_letter(msg_data, e)
+    if not rows:
+        return 0
+    try:
+        await insert_rows([row for _, row in rows])
+        return len(rows)
+    except ROW_ERRORS as e:
+        print(f"[store_messages_in_postgres] Batch of {len(rows)} rejected, retrying row by row: {e}")
+
+    written = 0
+    for msg_data, row in rows:
+        try:
+            await insert_rows([row])
+            written += 1
+        except ROW_ERRORS as e:
+            await dead_letter(msg_data, e)
+    return written
+
+async def store_batch(batch):
+    """
+    Redis and Postgres writes are independent, so run them concurrently, on
+    the records that passed check_record.
+    """
+    batch = await valid_records(batch)
+    if not batch:
+        return 0
+    _, written = await asyncio.gather(
+        store_hot_and_inbox(batch),
+        store_messages_in_postgres(batch),
+    )
+    return written
+
+# Message consumer callback (unbatched mode)
 async def on_persistence_message(msg: IncomingMessage):
     try:
         msg_data = json.loads(msg.body.decode())
-        await store_message_in_redis(msg_data)
-        await store_message_in_postgres(msg_data)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        print(f"[persistence-service] Dropping malformed message: {e}")
+        await msg.ack()
+        return
+    if not await valid_records([msg_data]):
+        await msg.ack()
+        return
+    try:
+        await asyncio.gather(
+            store_message_in_redis(msg_data),
+            store_message_in_postgres(msg_data),
+        )
         await msg.ack()
         print(f"[persistence-service] Stored message: {msg_data}")
     except Exception as e:
-        print(f"[persistence-service] Failed storing message: {e}")
+        print(f"[persistence-service] Failed storing message, requeueing: {e}")
+        await asyncio.sleep(STORE_RETRY_DELAY)
+        await msg.nack(requeue=True)
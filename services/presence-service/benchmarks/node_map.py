@@ -0,0 +1,107 @@
+"""
+Latency of /presence/nodes resolution vs. group size, before and after pipelining.
+
+Seeds `--devices` online devices for each of N synthetic users into a real Redis,
+then times the old per-user/per-device lookup against `resolve_node_map`.
+
+Run from services/presence-service (needs a reachable Redis, e.g. the compose
+one, used as the only shard, so leave PRESENCE_REDIS_SHARDS unset):
+
+    REDIS_HOST=localhost python -m benchmarks.node_map --sizes 10,50,200,1000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import redis.asyncio as redis
+
+from dependencies import REDIS_HOST, REDIS_PORT
+from routers.presence import resolve_node_map, lease_key, NODES_KEY
+
+
+async def sequential_node_map(redis_client, user_ids):
+    """
+    The lookup as it was before: one SMEMBERS per user, one HGETALL per device.
+    """
+    node_map = {}
+    for user_id in user_ids:
+        user_key = f"presence:{user_id}"
+        devices = await redis_client.smembers(f"{user_key}:devices")
+        for device_id in devices:
+            data = await redis_client.hgetall(f"{user_key}:{device_id}")
+            if not data or data.get("status") != "online" or not data.get("node_id"):
+                continue
+            node_map.setdefault(data["node_id"], []).append(
+                {"user_id": user_id, "device_id": device_id}
+            )
+    return node_map
+
+
+async def seed(redis_client, size, devices_per_user, nodes):
+    user_ids = [str(uuid.uuid4()) for _ in range(size)]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for i, user_id in enumerate(user_ids):
+            for d in range(devices_per_user):
+                device_id = f"bench-dev-{d}"
+                pipe.sadd(f"presence:{user_id}:devices", device_id)
+                pipe.hset(f"presence:{user_id}:{device_id}", mapping={
+                    "node_id": f"bench-node-{(i + d) % nodes + 1}",
+                    "device_id": device_id,
+                    "status": "online",
+                    "last_online": "bench",
+                })
+        # resolve_node_map only routes to nodes holding a lease
+        for n in range(nodes):
+            pipe.set(lease_key(f"bench-node-{n + 1}"), "bench", ex=600)
+            pipe.sadd(NODES_KEY, f"bench-node-{n + 1}")
+        await pipe.execute()
+    return user_ids
+
+
+async def cleanup(redis_client, user_ids, devices_per_user, nodes):
+    keys = [lease_key(f"bench-node-{n + 1}") for n in range(nodes)]
+    await redis_client.srem(NODES_KEY, *(f"bench-node-{n + 1}" for n in range(nodes)))
+    for user_id in user_ids:
+        keys.append(f"presence:{user_id}:devices")
+        keys.extend(f"presence:{user_id}:bench-dev-{d}" for d in range(devices_per_user))
+    for i in range(0, len(keys), 1000):
+        await redis_client.delete(*keys[i:i + 1000])
+
+
+async def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="2,10,50,100,200,500")
+    parser.add_argument("--devices", type=int, default=3)
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    print(f"{'group size':>10} {'sequential ms':>14} {'pipelined ms':>13} {'speedup':>8}")
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            user_ids = await seed(redis_client, size, args.devices, args.nodes)
+            try:
+                before = await timed(lambda: sequential_node_map(redis_client, user_ids), args.repeat)
+                after = await timed(lambda: resolve_node_map(redis_client, user_ids), args.repeat)
+                assert await sequential_node_map(redis_client, user_ids) == await resolve_node_map(redis_client, user_ids)
+            finally:
+                await cleanup(redis_client, user_ids, args.devices, args.nodes)
+            print(f"{size:>10} {before:>14.2f} {after:>13.2f} {before / after:>7.1f}x")
+    finally:
+        await redis_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
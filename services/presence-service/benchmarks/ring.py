@@ -0,0 +1,44 @@
+"""
+Key balance and key movement of the presence shard ring (sharding.HashRing)
+vs. plain modulo hashing, when a shard is added.
+
+Pure CPU, no Redis needed. Run from services/presence-service:
+
+    python -m benchmarks.ring --users 200000 --shards 2,3,4,8
+"""
+import argparse
+import uuid
+from collections import Counter
+
+from sharding import HashRing, ring_hash
+
+
+def shard_names(n):
+    return [f"presence-redis-{i + 1}:6379" for i in range(n)]
+
+
+def modulo_owner(names, key):
+    return names[ring_hash(key) % len(names)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--shards", default="2,3,4,8", help="shard counts to grow from (by one)")
+    parser.add_argument("--vnodes", type=int, default=160)
+    args = parser.parse_args()
+
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+    print(f"{'shards':>9} {'max/mean load':>14} {'ring moved':>11} {'modulo moved':>13} {'ideal':>7}")
+    for n in (int(s) for s in args.shards.split(",")):
+        before, after = shard_names(n), shard_names(n + 1)
+        ring_before, ring_after = HashRing(before, args.vnodes), HashRing(after, args.vnodes)
+        owners = [ring_before.shard_for(u) for u in user_ids]
+        load = max(Counter(owners).values()) / (args.users / n)
+        ring_moved = sum(o != ring_after.shard_for(u) for o, u in zip(owners, user_ids)) / args.users
+        modulo_moved = sum(modulo_owner(before, u) != modulo_owner(after, u) for u in user_ids) / args.users
+        print(f"{f'{n}->{n + 1}':>9} {load:>14.3f} {ring_moved:>10.1%} {modulo_moved:>12.1%} {1 / (n + 1):>6.1%}")
+
+
+if __name__ == "__main__":
+    main()
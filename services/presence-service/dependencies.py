@@ -1,16 +1,94 @@
 import os
+from typing import Callable, List, Tuple
 import redis.asyncio as redis
 
+from sharding import HashRing
+
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Connections shared by all requests; a request waits up to REDIS_POOL_TIMEOUT for a free one
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))  # seconds
+# Default lifetime of a node lease (routers/presence.py); nodes renew well within it
+NODE_LEASE_TTL = float(os.getenv("NODE_LEASE_TTL", "15"))  # seconds
+# Lock a replica holds while it backfills a shard's node indexes, extended as
+# the SCAN progresses, so another replica only takes over if it died
+NODE_INDEX_BACKFILL_LOCK_TTL = float(os.getenv("NODE_INDEX_BACKFILL_LOCK_TTL", "30"))  # seconds
+
+# Per-user presence keys (device sets, device hashes, node indexes) are spread
+# over these Redis instances ("host:port,host:port,...") by consistent hashing
+# of user_id. REDIS_HOST stays the control instance: node leases and the
+# presence_updates channel chat-service subscribes to. Defaults to a single
+# shard on the control instance. Locally, e.g. start `redis-server --port 6380`
+# and `--port 6381` and set PRESENCE_REDIS_SHARDS=localhost:6380,localhost:6381.
+PRESENCE_REDIS_SHARDS = [
+    shard.strip()
+    for shard in os.getenv("PRESENCE_REDIS_SHARDS", f"{REDIS_HOST}:{REDIS_PORT}").split(",")
+    if shard.strip()
+]
+PRESENCE_RING_VNODES = int(os.getenv("PRESENCE_RING_VNODES", "160"))
+
+
+def make_pool(host: str, port: int) -> redis.BlockingConnectionPool:
+    return redis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+    )
+
+
+def parse_shard(shard: str):
+    host, _, port = shard.rpartition(":")
+    return (host, int(port)) if host else (shard, 6379)
+
+
+redis_pool = make_pool(REDIS_HOST, REDIS_PORT)
+
+ring = HashRing(PRESENCE_REDIS_SHARDS, vnodes=PRESENCE_RING_VNODES)
+shard_pools = {
+    shard: redis_pool if parse_shard(shard) == (REDIS_HOST, REDIS_PORT) else make_pool(*parse_shard(shard))
+    for shard in ring.shards
+}
+shard_clients = {shard: redis.Redis(connection_pool=pool) for shard, pool in shard_pools.items()}
+
+
+def shard_for_user(user_id: str) -> redis.Redis:
+    """
+    Redis instance holding the presence keys of `user_id`.
+    """
+    return shard_clients[ring.shard_for(str(user_id))]
+
+
+def group_by_shard(items, user_id_of: Callable = str) -> List[Tuple[redis.Redis, list]]:
+    """
+    Splits `items` by the shard owning each one's user_id, keeping their order.
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(ring.shard_for(user_id_of(item)), []).append(item)
+    return [(shard_clients[shard], group) for shard, group in groups.items()]
+
+
+def register_script(script: str):
+    """
+    Registers a Lua script once, at import. Run it on any shard (or a pipeline
+    on one) with client=; it is loaded there on first use.
+    """
+    return redis.Redis(connection_pool=redis_pool).register_script(script)
+
+
+async def close_pools():
+    await redis_pool.disconnect()
+    for pool in shard_pools.values():
+        if pool is not redis_pool:
+            await pool.disconnect()
+
 
 async def get_redis():
     """
-    FastAPI dependency that yields an async Redis client.
+    FastAPI dependency that yields an async client for the control Redis, on
+    the shared connection pool, so requests don't pay for a new connection each.
     """
-    client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-    try:
-        yield client
-    finally:
-        # Optional: close the connection when done
-        await client.close()
+    yield redis.Redis(connection_pool=redis_pool)
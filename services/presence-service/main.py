@@ -3,15 +3,25 @@ import uvicorn
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 
+from redis.asyncio import Redis
+
 from routers import presence
+from dependencies import redis_pool, close_pools
 
 APP_ENV = os.getenv("APP_ENV", "development")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("[presence-service] Starting up (Redis only, no DB creation needed)...")
+    try:
+        indexed = await presence.backfill_node_index(Redis(connection_pool=redis_pool))
+        if indexed:
+            print(f"[presence-service] Indexed {indexed} online device(s) by node")
+    except Exception as e:
+        print(f"[presence-service] Node index backfill failed: {e}")
     yield
     print("[presence-service] Shutting down presence-service...")
+    await close_pools()
 
 app = FastAPI(lifespan=lifespan)
 
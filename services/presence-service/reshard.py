@@ -0,0 +1,129 @@
+"""
+Moves presence keys between Redis shards after PRESENCE_REDIS_SHARDS changes.
+
+Scans every shard of the old layout for users (presence:{user_id}:devices)
+and moves each user whose owner is different on the new ring: device hashes,
+device set and node index entries. With consistent hashing only those users
+are touched, e.g. about 1/(n+1) of them when a shard is added to n.
+
+Deploy presence-service with the new PRESENCE_REDIS_SHARDS first, then run
+from services/presence-service:
+
+    python -m reshard --from redis:6379 \\
+        --to presence-redis-1:6379,presence-redis-2:6379
+
+Until a user has been moved their devices look offline to /presence/nodes
+(or come back earlier with their next heartbeat). A device the new shard
+already has a record for (written after the deploy) is never overwritten.
+Use --dry-run to only count the users that would move.
+"""
+import argparse
+import asyncio
+
+import redis.asyncio as redis
+
+from dependencies import PRESENCE_RING_VNODES, parse_shard, register_script
+from routers.presence import node_index_key, index_member
+from sharding import HashRing
+
+# Copies one device onto its new shard unless that shard already has it.
+# KEYS: user's device set, device hash, node index of the device's node_id
+#       (only if it is online on one)
+# ARGV: index member, device_id, field, value, field, value, ...
+MOVE_DEVICE_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[2], unpack(ARGV, 3))
+redis.call('SADD', KEYS[1], ARGV[2])
+if KEYS[3] then
+    redis.call('ZADD', KEYS[3], 0, ARGV[1])
+end
+return 1
+"""
+move_device_script = register_script(MOVE_DEVICE_LUA)
+
+
+async def move_user(source, target, user_id: str) -> int:
+    """
+    Moves one user's presence keys from `source` to `target`. Returns the
+    devices copied.
+    """
+    user_key = f"presence:{user_id}"
+    device_ids = list(await source.smembers(f"{user_key}:devices"))
+    async with source.pipeline(transaction=False) as pipe:
+        for device_id in device_ids:
+            pipe.hgetall(f"{user_key}:{device_id}")
+        records = await pipe.execute()
+
+    async with target.pipeline(transaction=False) as pipe:
+        for device_id, fields in zip(device_ids, records):
+            if not fields:
+                continue
+            keys = [f"{user_key}:devices", f"{user_key}:{device_id}"]
+            if fields.get("status") == "online" and fields.get("node_id"):
+                keys.append(node_index_key(fields["node_id"]))
+            flat = [item for pair in fields.items() for item in pair]
+            await move_device_script(
+                keys=keys,
+                args=[index_member(user_id, device_id), device_id, *flat],
+                client=pipe,
+            )
+        copied = sum(await pipe.execute())
+
+    async with source.pipeline(transaction=True) as pipe:
+        for device_id, fields in zip(device_ids, records):
+            if fields.get("node_id"):
+                pipe.zrem(node_index_key(fields["node_id"]), index_member(user_id, device_id))
+            pipe.delete(f"{user_key}:{device_id}")
+        pipe.delete(f"{user_key}:devices")
+        await pipe.execute()
+    return copied
+
+
+async def reshard(from_shards, to_shards, dry_run=False):
+    old_ring = HashRing(from_shards, vnodes=PRESENCE_RING_VNODES)
+    new_ring = HashRing(to_shards, vnodes=PRESENCE_RING_VNODES)
+    clients = {
+        shard: redis.Redis(*parse_shard(shard), decode_responses=True)
+        for shard in set(old_ring.shards) | set(new_ring.shards)
+    }
+    scanned = moved = devices = 0
+    try:
+        for shard in old_ring.shards:
+            source = clients[shard]
+            async for devices_key in source.scan_iter(match="presence:*:devices", count=1000):
+                user_id = devices_key[len("presence:"):-len(":devices")]
+                if user_id.startswith("node:"):
+                    continue
+                scanned += 1
+                owner = new_ring.shard_for(user_id)
+                if owner == shard:
+                    continue
+                moved += 1
+                if not dry_run:
+                    devices += await move_user(source, clients[owner], user_id)
+    finally:
+        for client in clients.values():
+            await client.close()
+
+    share = moved / scanned if scanned else 0
+    action = "would move" if dry_run else f"moved ({devices} devices)"
+    print(f"[reshard] {scanned} users scanned, {moved} {action}: {share:.1%}")
+
+
+def split_shards(shards: str):
+    return [shard.strip() for shard in shards.split(",") if shard.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="from_shards", required=True, help="old PRESENCE_REDIS_SHARDS")
+    parser.add_argument("--to", dest="to_shards", required=True, help="new PRESENCE_REDIS_SHARDS")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(reshard(split_shards(args.from_shards), split_shards(args.to_shards), args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,412 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from datetime import datetime, timezone
-from typing import Dict, List
+from typing import Dict, List, Optional
+import asyncio
+import heapq
+import itertools
 import uuid
 
-from dependencies import get_redis
+import dependencies
+from dependencies import (
+    get_redis,
+    shard_for_user,
+    group_by_shard,
+    register_script,
+    NODE_LEASE_TTL,
+    NODE_INDEX_BACKFILL_LOCK_TTL,
+)
 
 router = APIRouter()
 
+# Every status change is announced here as "<user_id>:<device_id>:<status>" so
+# chat-service nodes can drop their cached routing entries for that user.
+PRESENCE_UPDATES_CHANNEL = "presence_updates"
+
+# Node leases. Each chat-service process holds presence:node:{node_id}:lease,
+# whose value is its epoch (a random id per process start), and renews it well
+# within NODE_LEASE_TTL (dependencies.py). Device hashes record the epoch they registered under,
+# so a device is only routable while its node's lease is alive *and* still
+# held by the same process: when a node crashes, one expired key takes all of
+# its devices out of routing, without touching any device key.
+NODES_KEY = "presence:nodes"  # every node that has ever held a lease
+
+
+def lease_key(node_id: str) -> str:
+    return f"presence:node:{node_id}:lease"
+
+
+# Sharding: the keys below that belong to a user (presence:{user_id}:...) live
+# on the user's shard (dependencies.shard_for_user); leases, NODES_KEY and the
+# updates channel live on the control Redis (get_redis). Each shard keeps its
+# own node indexes for the users it holds.
+#
+# Node index: presence:node:{node_id}:devices is a sorted set of
+# "{user_id}:{device_id}" for every device currently online on that node, all
+# with score 0 so it is ordered (and paged) lexicographically. Kept up to date
+# by every online/offline/heartbeat write, so listing a node's devices is a
+# range read and counting them is ZCARD, with no keyspace SCAN.
+def node_index_key(node_id: str) -> str:
+    return f"presence:node:{node_id}:devices"
+
+
+def index_member(user_id: str, device_id: str) -> str:
+    return f"{user_id}:{device_id}"
+
+
+# Set once the indexes have been backfilled from pre-existing presence data;
+# the lock keeps two replicas from backfilling a shard at the same time
+NODE_INDEX_BUILT_KEY = "presence:node_index:built"
+NODE_INDEX_LOCK_KEY = "presence:node_index:backfill_lock"
+
+
+# Scripts are registered once here and run with client= the shard (or a
+# pipeline on it). Every key a script touches is passed in KEYS.
+
+# Writes one device's presence and moves it between node indexes.
+# KEYS: user's device set, device hash, index of node_id, index of the
+#       previous node_id as read by the caller (= KEYS[3] if there is none)
+# ARGV: index member, device_id, status, node_id, last_online, epoch,
+#       previous node_id as read by the caller ('' if none)
+# Returns the previous [status, node_id, epoch] of the device, or nil if its
+# node_id is no longer the one the caller read (the caller reads it again).
+WRITE_DEVICE_LUA = """
+local previous = redis.call('HMGET', KEYS[2], 'status', 'node_id', 'epoch')
+if (previous[2] or '') ~= ARGV[7] then
+    return nil
+end
+if previous[2] and previous[2] ~= ARGV[4] then
+    redis.call('ZREM', KEYS[4], ARGV[1])
+end
+redis.call('SADD', KEYS[1], ARGV[2])
+redis.call('HSET', KEYS[2], 'node_id', ARGV[4], 'device_id', ARGV[2], 'status', ARGV[3],
+           'last_online', ARGV[5], 'epoch', ARGV[6])
+if ARGV[3] == 'online' then
+    redis.call('ZADD', KEYS[3], 0, ARGV[1])
+else
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+return previous
+"""
+write_device_script = register_script(WRITE_DEVICE_LUA)
+
+# Deletes a lease only if it is still held by the given epoch
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_lease_script = register_script(RELEASE_LEASE_LUA)
+
+# Extends a lock (ARGV[2] ms) only if it is still held by ARGV[1]
+EXTEND_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+extend_lock_script = register_script(EXTEND_LOCK_LUA)
+
+
 class PresenceStatus(BaseModel):
     user_id: uuid.UUID
     node_id: str
     device_id: str
     status: str  # "online" or "offline"
+    node_epoch: Optional[str] = None  # epoch of the node's lease at registration
+
+
+class NodeLease(BaseModel):
+    epoch: str
+    ttl: Optional[float] = None  # seconds, defaults to NODE_LEASE_TTL
+
+
+def device_fields(payload: PresenceStatus, status: str, now_utc: datetime) -> Dict[str, str]:
+    return {
+        "node_id": payload.node_id,
+        "device_id": payload.device_id,
+        "status": status,
+        "last_online": now_utc.isoformat(),
+        "epoch": payload.node_epoch or "",
+    }
+
+
+async def write_devices(shard, payloads: List[PresenceStatus], status: str, now_utc: datetime) -> list:
+    """
+    Stores the presence (hash, user's device set and node index) of devices
+    whose users are all on `shard`: one pipelined read of their current
+    node_id, then one pipeline of writes. A device whose node_id changed in
+    between is read and written again. Returns each device's previous
+    [status, node_id, epoch].
+    """
+    previous = [None] * len(payloads)
+    pending = list(range(len(payloads)))
+    while pending:
+        async with shard.pipeline(transaction=False) as pipe:
+            for i in pending:
+                pipe.hget(f"presence:{str(payloads[i].user_id)}:{payloads[i].device_id}", "node_id")
+            read_nodes = await pipe.execute()
+        async with shard.pipeline(transaction=False) as pipe:
+            for i, read_node in zip(pending, read_nodes):
+                payload = payloads[i]
+                user_key = f"presence:{str(payload.user_id)}"
+                fields = device_fields(payload, status, now_utc)
+                await write_device_script(
+                    keys=[
+                        f"{user_key}:devices",
+                        f"{user_key}:{payload.device_id}",
+                        node_index_key(payload.node_id),
+                        node_index_key(read_node or payload.node_id),
+                    ],
+                    args=[
+                        index_member(str(payload.user_id), payload.device_id),
+                        payload.device_id,
+                        status,
+                        payload.node_id,
+                        fields["last_online"],
+                        fields["epoch"],
+                        read_node or "",
+                    ],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+        for i, result in zip(pending, results):
+            previous[i] = result
+        pending = [i for i, result in zip(pending, results) if result is None]
+    return previous
+
+
+def is_routable(status, node_id, epoch, live_leases: Dict[str, str]) -> bool:
+    """
+    Online, on a node with a live lease, registered under that lease's epoch
+    (devices registered without an epoch only need the live lease).
+    """
+    if status != "online" or not node_id or node_id not in live_leases:
+        return False
+    return not epoch or epoch == live_leases[node_id]
+
+
+async def get_live_leases(redis_client) -> Dict[str, str]:
+    """
+    node_id -> epoch of every known node whose lease is alive.
+    """
+    nodes = sorted(await redis_client.smembers(NODES_KEY))
+    if not nodes:
+        return {}
+    epochs = await redis_client.mget([lease_key(node_id) for node_id in nodes])
+    return {node_id: epoch for node_id, epoch in zip(nodes, epochs) if epoch}
+
+class PresenceBatch(BaseModel):
+    devices: List[PresenceStatus]
+
+
+async def apply_presence_batch(redis_client, records: List[PresenceStatus], status: str):
+    """
+    Marks every device in `records` as `status` with two pipelined round trips
+    per shard (shards in parallel), then announces each change on the control
+    Redis in one more.
+    """
+    now_utc = datetime.now(timezone.utc)
+
+    await asyncio.gather(*(
+        write_devices(shard, shard_records, status, now_utc)
+        for shard, shard_records in group_by_shard(records, lambda payload: str(payload.user_id))
+    ))
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for payload in records:
+            pipe.publish(PRESENCE_UPDATES_CHANNEL, f"{str(payload.user_id)}:{payload.device_id}:{status}")
+        await pipe.execute()
+
 
 @router.post("/online")
 async def user_online(payload: PresenceStatus, redis_client = Depends(get_redis)):
     if payload.status.lower() != "online":
         raise HTTPException(status_code=400, detail="Use status='online' or call /offline.")
-    now_utc = datetime.now(timezone.utc)
-    user_key = f"presence:{str(payload.user_id)}"
-    device_key = f"{user_key}:{payload.device_id}"
-    await redis_client.sadd(f"{user_key}:devices", payload.device_id)
-    await redis_client.hset(device_key, mapping={
-        "node_id": payload.node_id,
-        "device_id": payload.device_id,
-        "status": "online",
-        "last_online": now_utc.isoformat()
-    })
-    # Optionally publish an event to a 'presence_updates' channel for real-time sync
-    # await redis_client.publish("presence_updates", f"{str(payload.user_id)}:{payload.device_id}:online")
+    await apply_presence_batch(redis_client, [payload], "online")
     return {"detail": "User/device is online"}
 
 @router.post("/offline")
 async def user_offline(payload: PresenceStatus, redis_client = Depends(get_redis)):
     if payload.status.lower() != "offline":
         raise HTTPException(status_code=400, detail="Use status='offline' or call /online.")
-    now_utc = datetime.now(timezone.utc)
-    user_key = f"presence:{str(payload.user_id)}"
-    device_key = f"{user_key}:{payload.device_id}"
-    await redis_client.sadd(f"{user_key}:devices", payload.device_id)
-    await redis_client.hset(device_key, mapping={
-        "node_id": payload.node_id,
-        "device_id": payload.device_id,
-        "status": "offline",
-        "last_online": now_utc.isoformat()
-    })
-    # Optionally publish an event to a 'presence_updates' channel
-    # await redis_client.publish("presence_updates", f"{str(payload.user_id)}:{payload.device_id}:offline")
+    await apply_presence_batch(redis_client, [payload], "offline")
     return {"detail": "User/device is offline"}
 
 
+@router.post("/online/batch")
+async def users_online(batch: PresenceBatch, redis_client = Depends(get_redis)):
+    """
+    /online for many devices at once (e.g. a node's clients reconnecting after
+    a restart): two Redis round trips per shard for the whole batch.
+    """
+    if any(payload.status.lower() != "online" for payload in batch.devices):
+        raise HTTPException(status_code=400, detail="Every device needs status='online'; use /offline/batch for the rest.")
+    await apply_presence_batch(redis_client, batch.devices, "online")
+    return {"detail": f"{len(batch.devices)} device(s) online"}
+
+
+@router.post("/offline/batch")
+async def users_offline(batch: PresenceBatch, redis_client = Depends(get_redis)):
+    """
+    /offline for many devices at once, in two Redis round trips per shard.
+    """
+    if any(payload.status.lower() != "offline" for payload in batch.devices):
+        raise HTTPException(status_code=400, detail="Every device needs status='offline'; use /online/batch for the rest.")
+    await apply_presence_batch(redis_client, batch.devices, "offline")
+    return {"detail": f"{len(batch.devices)} device(s) offline"}
+
+
 @router.post("/heartbeat")
 async def heartbeat(payload: PresenceStatus, redis_client = Depends(get_redis)):
     """
     Keep user/device as 'online' with a heartbeat.
     """
     now_utc = datetime.now(timezone.utc)
-    user_key = f"presence:{str(payload.user_id)}"
-    device_key = f"{user_key}:{payload.device_id}"
-    await redis_client.sadd(f"{user_key}:devices", payload.device_id)
-    await redis_client.hset(device_key, mapping={
-        "node_id": payload.node_id,
-        "device_id": payload.device_id,
-        "status": "online",
-        "last_online": now_utc.isoformat()
-    })
-    # Optionally publish presence_updates
+    previous, = await write_devices(shard_for_user(str(payload.user_id)), [payload], "online", now_utc)
+    # Only announce heartbeats that actually change routing
+    if previous != ["online", payload.node_id, payload.node_epoch or ""]:
+        await redis_client.publish(PRESENCE_UPDATES_CHANNEL, f"{str(payload.user_id)}:{payload.device_id}:online")
     return {"detail": "Heartbeat updated (Redis only)"}
 
 
+@router.put("/nodes/{node_id}/lease")
+async def renew_node_lease(node_id: str, payload: NodeLease, redis_client = Depends(get_redis)):
+    """
+    Takes or renews a node's lease. A different epoch replaces the previous
+    holder (the node restarted), which makes its old devices unroutable.
+    """
+    ttl = payload.ttl or NODE_LEASE_TTL
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(lease_key(node_id), payload.epoch, px=int(ttl * 1000))
+        pipe.sadd(NODES_KEY, node_id)
+        await pipe.execute()
+    return {"node_id": node_id, "epoch": payload.epoch, "ttl": ttl}
+
+
+@router.delete("/nodes/{node_id}/lease")
+async def release_node_lease(node_id: str, epoch: str, redis_client = Depends(get_redis)):
+    """
+    Graceful shutdown: drops the lease if `epoch` still holds it.
+    """
+    released = await release_lease_script(keys=[lease_key(node_id)], args=[epoch], client=redis_client)
+    return {"node_id": node_id, "released": bool(released)}
+
+
+@router.get("/nodes/live")
+async def get_live_nodes(redis_client = Depends(get_redis)) -> Dict[str, str]:
+    """
+    node_id -> epoch of every node whose lease is alive.
+    """
+    return await get_live_leases(redis_client)
+
+
+@router.get("/nodes/stats")
+async def get_node_stats(redis_client = Depends(get_redis)) -> Dict[str, Dict[str, object]]:
+    """
+    node_id -> {"devices": online devices indexed on the node, "live": whether
+    it holds a lease}, for every known node. One ZCARD per node and shard, in
+    one pipeline per shard (in parallel), summed over the shards.
+    """
+    nodes = sorted(await redis_client.smembers(NODES_KEY))
+
+    async def count_shard(shard):
+        async with shard.pipeline(transaction=False) as pipe:
+            for node_id in nodes:
+                pipe.zcard(node_index_key(node_id))
+            return await pipe.execute()
+
+    async def leases():
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for node_id in nodes:
+                pipe.exists(lease_key(node_id))
+            return await pipe.execute()
+
+    live, *shard_counts = await asyncio.gather(leases(), *map(count_shard, dependencies.shard_clients.values()))
+    return {
+        node_id: {"devices": sum(counts[i] for counts in shard_counts), "live": bool(live[i])}
+        for i, node_id in enumerate(nodes)
+    }
+
+
+@router.get("/nodes/{node_id}/devices")
+async def get_node_devices(
+    node_id: str,
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(500, ge=1, le=5000),
+):
+    """
+    Pages through the devices online on `node_id` (e.g. to drain it), in
+    stable lexicographic order. Each page is one ZRANGEBYLEX per shard (in
+    parallel), merged; next_cursor is None on the last page.
+    """
+    start = f"({cursor}" if cursor else "-"
+    pages = await asyncio.gather(*(
+        shard.zrangebylex(node_index_key(node_id), start, "+", start=0, num=limit)
+        for shard in dependencies.shard_clients.values()
+    ))
+    members = list(itertools.islice(heapq.merge(*pages), limit))
+    devices = []
+    for member in members:
+        user_id, _, device_id = member.partition(":")
+        devices.append({"user_id": user_id, "device_id": device_id})
+    return {
+        "node_id": node_id,
+        "devices": devices,
+        "next_cursor": members[-1] if len(members) == limit else None,
+    }
+
+
+async def backfill_node_index(redis_client) -> int:
+    """
+    Builds the node indexes of every shard from its existing device hashes
+    with one SCAN over its keyspace. Runs once per shard: NODE_INDEX_BUILT_KEY
+    is set when a backfill has completed, and NODE_INDEX_LOCK_KEY is held
+    while one runs, so a replica starting meanwhile skips the shard and one
+    that dies before finishing leaves it to the next start. Every write keeps
+    the indexes current afterwards. Returns the devices indexed.
+    """
+    indexed = 0
+    token = uuid.uuid4().hex
+    lock_ms = int(NODE_INDEX_BACKFILL_LOCK_TTL * 1000)
+    for shard in dependencies.shard_clients.values():
+        if await shard.exists(NODE_INDEX_BUILT_KEY):
+            continue
+        if not await shard.set(NODE_INDEX_LOCK_KEY, token, nx=True, px=lock_ms):
+            continue
+        try:
+            nodes = set()
+            scanned = 0
+            async for devices_key in shard.scan_iter(match="presence:*:devices", count=1000):
+                scanned += 1
+                if scanned % 1000 == 0 and not await extend_lock_script(
+                    keys=[NODE_INDEX_LOCK_KEY], args=[token, lock_ms], client=shard
+                ):
+                    raise RuntimeError("node index backfill lock lost")
+                user_key = devices_key[:-len(":devices")]
+                user_id = user_key[len("presence:"):]
+                if user_id.startswith("node:"):
+                    continue
+                device_ids = list(await shard.smembers(devices_key))
+                async with shard.pipeline(transaction=False) as pipe:
+                    for device_id in device_ids:
+                        pipe.hmget(f"{user_key}:{device_id}", "status", "node_id")
+                    states = await pipe.execute()
+                async with shard.pipeline(transaction=False) as pipe:
+                    for device_id, (status, node_id) in zip(device_ids, states):
+                        if status == "online" and node_id:
+                            pipe.zadd(node_index_key(node_id), {index_member(user_id, device_id): 0})
+                            nodes.add(node_id)
+                            indexed += 1
+                    await pipe.execute()
+            if nodes:
+                await redis_client.sadd(NODES_KEY, *nodes)
+            await shard.set(NODE_INDEX_BUILT_KEY, datetime.now(timezone.utc).isoformat())
+        finally:
+            await release_lease_script(keys=[NODE_INDEX_LOCK_KEY], args=[token], client=shard)
+    return indexed
+
+
 @router.get("/nodes")
 async def get_presence_node_map(
     user_ids: str = Query(..., description="Comma-separated user IDs"),
@@ -97,52 +434,90 @@ async def get_presence_node_map(
     doesn't have to loop over everything.
     """
     user_ids_list = [u.strip() for u in user_ids.split(",") if u.strip()]
+    return await resolve_node_map(redis_client, user_ids_list, sender_id, origin_device_id)
 
-    # We'll accumulate node_id -> [ {user_id, device_id}, ... ]
-    node_map = {}
 
-    for raw_user_id in user_ids_list:
+async def resolve_node_map(
+    redis_client,
+    user_ids: List[str],
+    sender_id: str = None,
+    origin_device_id: str = None,
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Groups the online devices of `user_ids` by node_id. Each shard answers for
+    its users in two pipelined round trips (all device sets, then all device
+    hashes); the shards are queried in parallel, together with the live node
+    leases on the control Redis, so the latency is that of the slowest shard
+    regardless of group size. Devices on nodes without a live lease are skipped.
+    """
+    valid_user_ids = []
+    for raw_user_id in user_ids:
         # If your IDs are guaranteed to be UUID, you can validate here
         try:
             _ = uuid.UUID(raw_user_id)
         except ValueError:
             # if not a valid UUID, skip or raise
             continue
+        valid_user_ids.append(raw_user_id)
 
-        user_key = f"presence:{raw_user_id}"
-        device_set_key = f"{user_key}:devices"
-        devices = await redis_client.smembers(device_set_key)
-        if not devices:
-            continue
+    if not valid_user_ids:
+        return {}
 
-        for device_id in devices:
-            device_key = f"{user_key}:{device_id}"
-            data = await redis_client.hgetall(device_key)
-            if not data:
-                continue
-
-            # Only handle if status == 'online'
-            if data.get("status") != "online":
-                continue
-
-            # Possibly exclude origin device if user==sender
-            if (raw_user_id == sender_id) and (device_id == origin_device_id):
-                continue
-
-            node_id = data.get("node_id")
-            if not node_id:
-                continue
-
-            if node_id not in node_map:
-                node_map[node_id] = []
-            node_map[node_id].append({
-                "user_id": raw_user_id,
-                "device_id": device_id
-            })
+    live_leases, *shard_states = await asyncio.gather(
+        get_live_leases(redis_client),
+        *(
+            get_device_states(shard, shard_user_ids, sender_id, origin_device_id)
+            for shard, shard_user_ids in group_by_shard(valid_user_ids)
+        ),
+    )
+
+    # We'll accumulate node_id -> [ {user_id, device_id}, ... ]
+    node_map = {}
+    for user_id, device_id, status, node_id, epoch in itertools.chain.from_iterable(shard_states):
+        # Only online devices whose node is still alive
+        if not is_routable(status, node_id, epoch, live_leases):
+            continue
+        node_map.setdefault(node_id, []).append({
+            "user_id": user_id,
+            "device_id": device_id
+        })
 
     return node_map
 
 
+async def get_device_states(shard, user_ids: List[str], sender_id: str = None, origin_device_id: str = None):
+    """
+    (user_id, device_id, status, node_id, epoch) of every device of `user_ids`,
+    all held by `shard`, in two pipelined round trips.
+    """
+    # Round trip 1: device set of every user
+    async with shard.pipeline(transaction=False) as pipe:
+        for user_id in user_ids:
+            pipe.smembers(f"presence:{user_id}:devices")
+        device_sets = await pipe.execute()
+
+    candidates = [
+        (user_id, device_id)
+        for user_id, devices in zip(user_ids, device_sets)
+        for device_id in devices
+        # Possibly exclude origin device if user==sender
+        if not (user_id == sender_id and device_id == origin_device_id)
+    ]
+    if not candidates:
+        return []
+
+    # Round trip 2: status + node + lease epoch of every candidate device
+    async with shard.pipeline(transaction=False) as pipe:
+        for user_id, device_id in candidates:
+            pipe.hmget(f"presence:{user_id}:{device_id}", "status", "node_id", "epoch")
+        device_states = await pipe.execute()
+
+    return [
+        (user_id, device_id, status, node_id, epoch)
+        for (user_id, device_id), (status, node_id, epoch) in zip(candidates, device_states)
+    ]
+
+
 @router.get("/{user_id}")
 async def get_presence(user_id: str, redis_client = Depends(get_redis)):
     """
@@ -158,20 +533,27 @@ async def get_presence(user_id: str, redis_client = Depends(get_redis)):
     user_key = f"presence:{str(user_uuid)}"
     device_set_key = f"{user_key}:devices"
 
+    shard = shard_for_user(str(user_uuid))
+
     # 1) Get all device_ids for this user
-    devices = await redis_client.smembers(device_set_key)
+    devices = await shard.smembers(device_set_key)
     if not devices:
         raise HTTPException(status_code=404, detail="No presence record found for this user")
 
+    live_leases = await get_live_leases(redis_client)
     records = []
     for device_id in devices:
         device_key = f"{user_key}:{device_id}"
-        data = await redis_client.hgetall(device_key)
+        data = await shard.hgetall(device_key)
         if data:
+            status = data.get("status")
+            # "online" on a node that is gone (crashed or restarted)
+            if status == "online" and not is_routable(status, data.get("node_id"), data.get("epoch"), live_leases):
+                status = "unreachable"
             records.append({
                 "device_id": data.get("device_id"),
                 "node_id": data.get("node_id"),
-                "status": data.get("status"),
+                "status": status,
                 "last_online": data.get("last_online")
             })
 
@@ -0,0 +1,35 @@
+import bisect
+import hashlib
+from typing import Iterable
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring over shard names ("host:port").
+
+    Each shard is placed on the ring at `vnodes` points derived from its name
+    only, so the owner of a key depends on the set of shards and not on their
+    order or count: adding a shard moves about 1/(n+1) of the keys (all onto
+    the new shard) and removing one moves only the keys it owned.
+    """
+
+    def __init__(self, shards: Iterable[str], vnodes: int = 160):
+        self.shards = sorted(set(shards))
+        if not self.shards:
+            raise ValueError("HashRing needs at least one shard")
+        points = sorted(
+            (ring_hash(f"{shard}#{i}"), shard)
+            for shard in self.shards
+            for i in range(vnodes)
+        )
+        self._hashes = [h for h, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._owners[index]
+